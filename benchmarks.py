@@ -0,0 +1,28 @@
+import statistics
+import subprocess
+import sys
+import timeit
+
+
+def bench_import(repeat=20):
+    """Wall time of a fresh interpreter running `import byteasm`,
+    less that of one that imports nothing."""
+
+    def run(stmt):
+        cmd = [sys.executable, "-S", "-c", stmt]
+        times = []
+        for _ in range(repeat):
+            times.append(timeit.timeit(lambda: subprocess.run(cmd, check=True), number=1))
+        return statistics.median(times)
+
+    baseline = run("import sys; sys.path.insert(0, '.')")
+    loaded = run("import sys; sys.path.insert(0, '.'); import byteasm")
+    return loaded - baseline
+
+
+def main():
+    print(f"import byteasm: {bench_import() * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,7 @@
+from . analysis import *
+from . assemble import *
 from . builder import *
+from . memory import *
+from . passes import *
+from . records import *
+from . verify import *
@@ -3,11 +3,14 @@ from . utils import *
 import collections
 import functools
 import itertools
+import weakref
 
 __all__ = [
     'add_expr'
   , 'atomic_expr'
   , 'cons_expr'
+  , 'empty_frames'
+  , 'FrameStack'
   , 'free_vars'
   , 'head_expr'
   , 'neg_expr'
@@ -171,6 +174,61 @@ class SelectExpr( Expr ) :
     return format_function_application( 'select', self.term0, self.term1, self.term2 )
 
 
+##
+class FrameStack( object ) :
+
+  # A persistent stack of frames, as a chain of cells each holding
+  # a frame and the stack beneath it. Cells are only made by
+  # `_push_frame`, which interns them, so equal stacks are the same
+  # object: pushing, popping, hashing and comparing all take constant
+  # time however deep the stack is. Iterating gives the frames from
+  # the top down, as the tuples once used to represent them did.
+  #
+  # The intern table holds cells weakly, so a stack lives only as
+  # long as the analysis results that refer to it. For the same
+  # reason, stacks bypass the memoized expression constructors
+
+  __slots__ = ( 'head', 'tail', 'depth', 'free', '__weakref__' )
+
+  def __init__( self, head, tail ) :
+    self.head  = head
+    self.tail  = tail
+    if tail is None :
+      self.depth = 0
+      self.free  = fully_bound
+    else :
+      self.depth = tail.depth + 1
+      self.free  = _free_vars( [head, tail] )
+
+  def __len__( self ) :
+    return self.depth
+
+  def __iter__( self ) :
+    cell = self
+    while cell.tail is not None :
+      yield cell.head
+      cell = cell.tail
+
+  def __str__( self ) :
+    return str( tuple(self) )
+
+  def __repr__( self ) :
+    return str(self)
+
+
+empty_frames = FrameStack( None, None )
+
+_interned_frames = weakref.WeakValueDictionary()
+
+def _push_frame( head, tail ) :
+  key = (head, tail)
+  cell = _interned_frames.get( key )
+  if cell is None :
+    cell = FrameStack( head, tail )
+    _interned_frames[ key ] = cell
+  return cell
+
+
 ##################################################
 #                                                #
 ##################################################
@@ -188,16 +246,28 @@ def neg_expr( expr ) :
     return add_expr( *map(neg_expr,expr.terms) )
   return NegExpr( expr )
 
-@memoize
 def head_expr( expr ) :
+  if isinstance(expr,FrameStack) :
+    assert expr.depth
+    return expr.head
+  return _head_expr( expr )
+
+@memoize
+def _head_expr( expr ) :
   if isinstance(expr,tuple) :
     return expr[0]
   if isinstance(expr,ConsExpr) :
     return expr.terms[0]
   return HeadExpr( expr )
 
-@memoize
 def tail_expr( expr ) :
+  if isinstance(expr,FrameStack) :
+    assert expr.depth
+    return expr.tail
+  return _tail_expr( expr )
+
+@memoize
+def _tail_expr( expr ) :
   if isinstance(expr,tuple) :
     assert expr
     return expr[1:]
@@ -253,8 +323,16 @@ def add_expr( *exprs ) :
 
   return AddExpr( *terms )
 
-@memoize
 def cons_expr( *exprs ) :
+  agg = exprs[-1]
+  if isinstance(agg,FrameStack) :
+    for a in reversed(exprs[:-1]) :
+      agg = _push_frame( a, agg )
+    return agg
+  return _cons_expr( *exprs )
+
+@memoize
+def _cons_expr( *exprs ) :
 
   *args,agg = exprs
 
@@ -286,7 +364,7 @@ def _free_vars( terms ) :
   for t in terms :
     if isinstance(t,tuple) :
       terms.extend(t)
-    elif isinstance(t,Expr) and t.free :
+    elif isinstance(t,(Expr,FrameStack)) and t.free :
       items.append(t.free)
 
   if not items :
@@ -331,6 +409,10 @@ class Replacement( object ) :
     elif isinstance(value,tuple) :
       result = tuple( map(self,value) )
 
+    elif isinstance(value,FrameStack) :
+      if value.free :
+        result = cons_expr( *map(self,value), empty_frames )
+
     if result != value :
       return result
 
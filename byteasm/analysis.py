@@ -0,0 +1,341 @@
+from . constants import *
+from . stack import *
+
+import collections
+import functools
+
+__all__ = [
+    'Analysis'
+  , 'analysis_pass'
+  , 'run_passes'
+  ]
+
+##################################################
+#                                                #
+##################################################
+def _op_stack_effects( ops, labels ) :
+
+  # Partitions the instruction stream into blocks using the same
+  # machinery that `assemble` uses to compute stack depth. Here,
+  # however, instructions are addressed by their index in `ops`
+  # rather than a byte offset, so jump targets are label indices
+
+  se = StackEffects( labels )
+  for idx, (line, op, typ, raw, fop) in enumerate(ops) :
+
+    if typ == AbsLabelArg or typ == RelLabelArg :
+      raw = labels[raw]
+      arg = 0
+    elif typ == GenericArg :
+      arg = raw
+    elif typ == NilArg :
+      arg = None
+    else :
+      arg = 0
+
+    se.insert( idx, 1, op, raw, arg, typ )
+
+  return se
+
+
+##################################################
+#                                                #
+##################################################
+# Each analysis depends on some aspect of the instruction stream:
+#
+#   * SHAPE   - how the stream divides into blocks and how they
+#               are linked: opcodes, jump targets and labels
+#   * STACK   - the shape, plus the args that stack effects depend on
+#   * LOCALS  - which locals each instruction reads or writes
+#
+# and is kept across an edit to the stream if none of these change
+
+SHAPE , \
+STACK , \
+LOCALS  = range(3)
+
+def _key( kind, ops, labels ) :
+  if kind == SHAPE :
+    flow = tuple(
+        (op, raw if typ == AbsLabelArg or typ == RelLabelArg else None)
+          for _, op, typ, raw, _ in ops
+      )
+    return flow, tuple(sorted( labels.items() ))
+  if kind == STACK :
+    return tuple(
+        (op, raw if typ == GenericArg else None)
+          for _, op, typ, raw, _ in ops
+      )
+  if kind == LOCALS :
+    return tuple(
+        (op, raw) if typ == LocalArg else None
+          for _, op, typ, raw, _ in ops
+      )
+
+
+def _cached( *depends ) :
+  def decorate( f ) :
+    name = f.__name__
+    @functools.wraps( f )
+    def get( self ) :
+      cache = self._cache
+      if name not in cache :
+        cache[ name ] = f( self )
+      return cache[ name ]
+    get.depends = frozenset( depends )
+    return property( get )
+  return decorate
+
+
+##
+class Analysis( object ) :
+
+  # Facts about an instruction stream (as passes see it) that are
+  # computed the first time they are asked for and then cached.
+  # Blocks are keyed by the index of their first instruction.
+  #
+  # When a pass produces a new stream, `update` returns the analysis
+  # of that stream, carrying over the results that the edit could
+  # not have changed. Results are shared, and must not be modified.
+  #
+  # `max_states` is the number of states the stack analysis keeps
+  # for a block before widening it, after which the block keeps one
+  # per sequence of exception flags, those saved in its frames and
+  # the current one (see `widened`)
+
+  def __init__( self, ops, labels, max_states=None ) :
+    self.ops        = ops
+    self.labels     = labels
+    self.max_states = max_states
+    self._cache     = {}
+    self._keys  = {}
+
+  def _key( self, kind ) :
+    if kind not in self._keys :
+      self._keys[ kind ] = _key( kind, self.ops, self.labels )
+    return self._keys[ kind ]
+
+  def update( self, ops, labels ) :
+
+    if ops is self.ops and labels is self.labels :
+      return self
+
+    result = Analysis( ops, labels, self.max_states )
+    for name, value in self._cache.items() :
+      depends = getattr( Analysis, name ).fget.depends
+      if all( self._key(k) == result._key(k) for k in depends ) :
+        result._cache[ name ] = value
+    return result
+
+  def invalidate( self, *names ) :
+    # drops cached results, all of them if no names are given
+    if names :
+      for name in names :
+        self._cache.pop( name, None )
+    else :
+      self._cache.clear()
+
+  @_cached( SHAPE, STACK )
+  def blocks( self ) :
+    # every block, reachable or not, mapped to its `Block`
+    return dict( _op_stack_effects( self.ops, self.labels ).blocks() )
+
+  @_cached( SHAPE, STACK )
+  def cfg( self ) :
+    # the reachable blocks, annotated with the states of the value
+    # stack, block stack and exception flag on exit from each
+    return make_annotated_cfg( _op_stack_effects( self.ops, self.labels ), max_states=self.max_states )
+
+  @_cached( SHAPE, STACK )
+  def stack_depth( self ) :
+    return annotated_stack_depth( self.cfg )
+
+  @_cached( SHAPE, STACK )
+  def widened( self ) :
+    # the blocks whose states were merged to keep the analysis small.
+    # If there are any, `stack_depth` is an upper bound
+    return frozenset( ip for ip, blk in self.cfg.items() if blk.widened )
+
+  @_cached( SHAPE )
+  def successors( self ) :
+    blocks = self.blocks
+    return {
+        ip : tuple( t for t in blk.targets if t in blocks )
+          for ip, blk in blocks.items()
+      }
+
+  @_cached( SHAPE )
+  def predecessors( self ) :
+    preds = { ip : [] for ip in self.blocks }
+    for ip, succ in self.successors.items() :
+      for t in succ :
+        preds[ t ].append( ip )
+    return { ip : tuple(v) for ip, v in preds.items() }
+
+  @_cached( SHAPE )
+  def reverse_postorder( self ) :
+    # the blocks reachable from the first, in reverse postorder
+    succ  = self.successors
+    order = []
+    seen  = set()
+    if 0 in succ :
+      seen.add( 0 )
+      stack = [ (0, iter(succ[0])) ]
+      while stack :
+        ip, it = stack[-1]
+        for t in it :
+          if t not in seen :
+            seen.add( t )
+            stack.append( (t, iter(succ[t])) )
+            break
+        else :
+          stack.pop()
+          order.append( ip )
+    order.reverse()
+    return tuple(order)
+
+  @_cached( SHAPE )
+  def dominators( self ) :
+
+    # maps each reachable block to the set of blocks that dominate
+    # it (including itself)
+    order = self.reverse_postorder
+    preds = self.predecessors
+    if not order :
+      return {}
+
+    dom = { order[0] : frozenset((order[0],)) }
+    changed = True
+    while changed :
+      changed = False
+      for ip in order[1:] :
+        known = [ dom[p] for p in preds[ip] if p in dom ]
+        new = frozenset.intersection( *known ) | {ip}
+        if dom.get( ip ) != new :
+          dom[ ip ] = new
+          changed = True
+    return dom
+
+  @_cached( SHAPE )
+  def loops( self ) :
+
+    # maps the header of each natural loop to the blocks of its
+    # body. Loops sharing a header are merged
+    dom   = self.dominators
+    preds = self.predecessors
+
+    loops = {}
+    for ip in dom :
+      for t in self.successors[ ip ] :
+        if t in dom[ ip ] :
+          body = set( (t,ip) )
+          pending = [ip]
+          while pending :
+            for src in preds[ pending.pop() ] :
+              if src not in body and src in dom :
+                body.add( src )
+                pending.append( src )
+          loops[ t ] = loops.get( t, frozenset() ) | body
+    return loops
+
+  @_cached( SHAPE )
+  def loop_depths( self ) :
+    depth = dict.fromkeys( self.blocks, 0 )
+    for body in self.loops.values() :
+      for ip in body :
+        depth[ ip ] += 1
+    return depth
+
+  @_cached( SHAPE, LOCALS )
+  def liveness( self ) :
+
+    # Computes, for every block, the set of local variables that are
+    # live on entry to and exit from it. Returns the two mappings,
+    # as well as the set of locals that are live on entry to an
+    # exception handler.
+    #
+    # Handlers are only linked to the instruction that installs
+    # them, but can be entered from anywhere in the protected
+    # region. Rather than model that, callers should leave locals
+    # that are live into a handler alone
+
+    ops    = self.ops
+    blocks = self.blocks
+
+    uses = {}
+    defs = {}
+    handlers = set()
+    for ip, blk in blocks.items() :
+      use = set()
+      kill = set()
+      for idx, _, op, raw, _, typ, _ in blk.instructions :
+        if typ == LocalArg :
+          # DELETE_FAST fails on an unbound local, so it reads the
+          # local before clearing it
+          name = ops[idx][3]
+          if op == LOAD_FAST or op == DELETE_FAST :
+            if name not in kill :
+              use.add( name )
+          if op != LOAD_FAST :
+            kill.add( name )
+        elif op in _handler_ops :
+          handlers.add( raw )
+      uses[ ip ] = use
+      defs[ ip ] = kill
+
+    live_in  = { ip : set() for ip in blocks }
+    live_out = { ip : set() for ip in blocks }
+
+    changed = True
+    while changed :
+      changed = False
+      for ip in sorted( blocks, reverse=True ) :
+        out = set()
+        for tgt in blocks[ip].targets :
+          if tgt in live_in :
+            out |= live_in[ tgt ]
+        live_out[ ip ] = out
+        new = uses[ ip ] | (out - defs[ ip ])
+        if new != live_in[ ip ] :
+          live_in[ ip ] = new
+          changed = True
+
+    pinned = set()
+    for ip in handlers :
+      if ip in live_in :
+        pinned |= live_in[ ip ]
+
+    return live_in, live_out, pinned
+
+
+_handler_ops = frozenset(( SETUP_FINALLY, SETUP_WITH, SETUP_ASYNC_WITH ))
+
+
+##################################################
+#                                                #
+##################################################
+def analysis_pass( f ) :
+
+  # Marks a pass as taking the analysis of its input as the keyword
+  # argument `analysis`, so that results can be shared between the
+  # passes run over a function
+  f.uses_analysis = True
+  return f
+
+
+def run_passes( ops, labels, signature, passes, analysis=None ) :
+
+  # Runs passes in order, each over the output of the one before.
+  # Returns the final instruction stream along with its analysis
+
+  if analysis is None :
+    analysis = Analysis( ops, labels )
+
+  for p in passes :
+    if getattr( getattr( p, 'func', p ), 'uses_analysis', False ) :
+      ops, labels = p( ops, labels, signature, analysis=analysis )
+    else :
+      ops, labels = p( ops, labels, signature )
+    analysis = analysis.update( ops, labels )
+
+  return ops, labels, analysis
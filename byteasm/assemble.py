@@ -1,14 +1,26 @@
+from . analysis import *
 from . constants import *
 from . stack import *
 from . utils import *
+from . verify import *
 
+import builtins
 import collections
-import inspect
+import math
+import opcode
+import sys
 import types
+import weakref
 
 __all__ = [
     'assemble'
+  , 'assemble_code'
+  , 'assemble_lazy'
+  , 'assembled_functions'
+  , 'clear_shared_constants'
   , 'fop'
+  , 'rebind_globals'
+  , 'signature_defaults'
   ]
 
 ##################################################
@@ -16,12 +28,45 @@ __all__ = [
 ##################################################
 _visualization_hook = PASS
 
+# immutable constants at least this long are shared between
+# every code object assembled in the process. Strings, bytes and 
+# tuples cannot be weakly referenced, so the table keeps the most
+# recently used `SharedConstantMaxCount` of them alive; older ones
+# are dropped, and remain only in the code objects that use them
+SharedConstantMinLength = 16
+SharedConstantMaxCount  = 1024
+
+_shared_constants = collections.OrderedDict()
+
+# every function produced here that is still alive
+_assembled = weakref.WeakSet()
+
 ##################################################
 #                                                #
 ##################################################
+# `YIELD_FROM` makes a generator unless the function is a coroutine, 
+# in which case it is part of an `await`. Which is only known once 
+# every instruction has been seen, so it is noted with a bit that
+# is not a real flag and resolved by `_resolve_generator_flags`
+_CO_YIELD_FROM = 0x40000000
+
+# END_ASYNC_FOR is not present before python 3.8
+_async_ops = frozenset(
+    opcode.opmap[name] for name in (
+        'GET_AWAITABLE', 'GET_AITER', 'GET_ANEXT', 'BEFORE_ASYNC_WITH'
+      , 'SETUP_ASYNC_WITH', 'END_ASYNC_FOR'
+      ) if name in opcode.opmap
+  )
+
 def _set_generator_flag( flags ) :
   return flags|CO_GENERATOR
 
+def _set_yield_from_flag( flags ) :
+  return flags|_CO_YIELD_FROM
+
+def _set_coroutine_flag( flags ) :
+  return flags|CO_COROUTINE
+
 def _unset_optimized_flag( flags ) :
   return flags&~CO_OPTIMIZED
 
@@ -30,20 +75,48 @@ def fop( code ) :
   if code == YIELD_VALUE :
     return _set_generator_flag
 
+  if code == YIELD_FROM :
+    return _set_yield_from_flag
+
+  if code in _async_ops :
+    return _set_coroutine_flag
+
   if code in ( DELETE_NAME, LOAD_NAME, STORE_NAME ) :
     return _unset_optimized_flag
 
 
+def _resolve_generator_flags( flags ) :
+
+  # a coroutine that also yields is an async generator
+  yield_from = flags & _CO_YIELD_FROM
+  flags &= ~_CO_YIELD_FROM
+  if flags & CO_ASYNC_GENERATOR :
+    flags &= ~(CO_COROUTINE|CO_GENERATOR)
+  elif flags & CO_COROUTINE :
+    if flags & CO_GENERATOR :
+      flags &= ~(CO_COROUTINE|CO_GENERATOR)
+      flags |= CO_ASYNC_GENERATOR
+  elif yield_from :
+    flags |= CO_GENERATOR
+  return flags
+
+
 ##################################################
 #                                                #
 ##################################################
-def _make_closure( value ) :
-  # python requires `__closure__` values to be of the
-  # `cell`, but doesn't give us a python API with which to
-  # create them. To get one, we create a pure-python
-  # function through the normal route and steal a
-  # copy of the cell variable from the result
-  return (lambda : value).__closure__[0]
+if hasattr( types, 'CellType' ) :
+
+  _make_closure = types.CellType
+
+else :
+
+  def _make_closure( value ) :
+    # python requires `__closure__` values to be of the
+    # `cell`, but doesn't give us a python API with which to
+    # create them. To get one, we create a pure-python
+    # function through the normal route and steal a
+    # copy of the cell variable from the result
+    return (lambda : value).__closure__[0]
 
 
 ##################################################
@@ -61,6 +134,82 @@ class InternArray( collections.OrderedDict ) :
     return tuple( self.keys() )
 
 
+##
+_simple_constant_types = frozenset(( int, str, bytes, bool, type(None) ))
+
+def _constant_key( value ) :
+
+  # Equality alone is not enough to decide whether two constants
+  # can share a slot: `1`, `1.0` and `True` are all equal, as are
+  # `0.0` and `-0.0`, and the same holds elementwise for tuples
+  # and frozensets. Keys therefore carry the type (and the sign of
+  # floating point values). Unhashable values are keyed by 
+  # identity; the pool keeps them alive, so the id is stable
+
+  typ = type(value)
+
+  if typ is tuple or typ is frozenset :
+    item_types = set( map(type,value) )
+    if len(item_types) == 1 and item_types <= _simple_constant_types :
+      return typ, value, item_types.pop()
+    return typ, typ( map(_constant_key,value) )
+
+  if typ is float :
+    return typ, value, math.copysign( 1.0, value )
+
+  if typ is complex :
+    return typ, value, math.copysign( 1.0, value.real ), math.copysign( 1.0, value.imag )
+
+  try :
+    hash(value)
+  except TypeError :
+    return typ, id(value)
+
+  return typ, value
+
+
+def _shared_constant( key, value ) :
+  if isinstance(value,(tuple,frozenset,str,bytes)) \
+      and len(value) >= SharedConstantMinLength :
+    try :
+      hash(value)
+    except TypeError :
+      return value
+    shared = _shared_constants.setdefault( key, value )
+    _shared_constants.move_to_end( key )
+    while len(_shared_constants) > SharedConstantMaxCount :
+      _shared_constants.popitem( last=False )
+    return shared
+  return value
+
+
+def clear_shared_constants() :
+  _shared_constants.clear()
+
+
+##
+class ConstantPool( object ) :
+
+  def __init__( self ) :
+    self._slots  = {}
+    self._values = []
+
+  def __len__( self ) :
+    return len(self._values)
+
+  def insert( self, value ) :
+    key = _constant_key( value )
+    idx = self._slots.get( key )
+    if idx is None :
+      idx = len(self._values)
+      self._slots[ key ] = idx
+      self._values.append( _shared_constant( key, value ) )
+    return idx
+
+  def as_tuple( self ) :
+    return tuple( self._values )
+
+
 ##
 class LineNumbering( object ) :
 
@@ -127,23 +276,199 @@ def assemble(
       , ops
       , labels
       , closure_values
+      , passes            = ()
+      , bind_globals      = ()
+      , rebindable        = False
+      , cellvars          = ()
+      , debug_info        = DEBUG_INFO_FULL
+      , verify            = True
+      , freevars          = ()
+      , code_flags        = 0
+      ) :
+
+  if fglobals is None :
+    fglobals = sys._getframe(1).f_globals
+
+  ops = _bind_outer_globals( ops, fglobals )
+
+  # resolve selected globals now and load them as constants
+  bindings = {}
+  if bind_globals :
+    if rebindable :
+      params = dict(
+                  name              = name
+                , fglobals          = fglobals
+                , signature         = signature
+                , docstring         = docstring
+                , stackdepth        = stackdepth
+                , filename          = filename
+                , ops               = list(ops)
+                , labels            = dict(labels)
+                , closure_values    = dict(closure_values)
+                , passes            = tuple(passes)
+                , bind_globals      = bind_globals
+                , cellvars          = tuple(cellvars)
+                , debug_info        = debug_info
+                , verify            = verify
+                , freevars          = tuple(freevars)
+                , code_flags        = code_flags
+                )
+    ops, bindings = _bind_globals( ops, fglobals, bind_globals )
+
+  co = assemble_code(
+            name              = name
+          , signature         = signature
+          , stackdepth        = stackdepth
+          , filename          = filename
+          , ops               = ops
+          , labels            = labels
+          , passes            = passes
+          , cellvars          = cellvars
+          , debug_info        = debug_info
+          , verify            = verify
+          , freevars          = freevars
+          , code_flags        = code_flags
+          )
+
+  # build function object
+  positional_defaults, keyword_defaults = signature_defaults( signature )
+
+  closure = []
+  for k in co.co_freevars :
+    closure.append(_make_closure(closure_values[k]))
+
+  fn = types.FunctionType( 
+              co
+            , fglobals
+            , name
+            , positional_defaults or None
+            , tuple(closure) or None
+            )
+
+  if keyword_defaults :
+    fn.__kwdefaults__ = keyword_defaults
+
+  if docstring is not None and debug_info == DEBUG_INFO_FULL :
+    fn.__doc__ = docstring
+
+  if bindings and rebindable :
+    _rebind_info[ fn ] = params, bindings
+
+  _assembled.add( fn )
+
+  return fn
+
+
+def assembled_functions() :
+  return list(_assembled)
+
+
+##
+def signature_defaults( signature ) :
+
+  positional_defaults = []
+  keyword_defaults    = {}
+
+  for p in signature.parameters.values() :
+    if p.default is not p.empty :
+      if p.kind == p.KEYWORD_ONLY :
+        keyword_defaults[p.name] = p.default
+      else :
+        positional_defaults.append( p.default )
+
+  return tuple(positional_defaults), keyword_defaults
+
+
+##
+def _check_labels( ops, labels, origins=None ) :
+
+  # jumps must be to a defined label, on an instruction. `origins`
+  # gives the builder index of each instruction, if not its own
+  end = len(ops)
+  for idx, (line, op, typ, raw, fop) in enumerate(ops) :
+    if typ == AbsLabelArg or typ == RelLabelArg :
+      if origins is not None :
+        idx = origins[idx]
+      if raw not in labels :
+        raise VerifyError( f'undefined label {raw!r}', None, idx, line )
+      if labels[raw] >= end :
+        raise VerifyError( f'label {raw!r} is past the last instruction', None, idx, line )
+
+
+##
+def assemble_code( 
+        name
+      , signature
+      , stackdepth
+      , filename
+      , ops
+      , labels
+      , passes            = ()
+      , cellvars          = ()
+      , debug_info        = DEBUG_INFO_FULL
+      , verify            = True
+      , freevars          = ()
+      , code_flags        = 0
       ) :
 
+  # `freevars` optionally fixes the order of the leading free
+  # variables, which otherwise follow the order they are first used
+  # in after passes have run. `code_flags` are added to the flags
+  # implied by the instructions, for the kinds of function that
+  # none of them give away, such as a coroutine that never awaits
+  # or an async generator that only yields.
+  #
+  # Debug info levels:
+  #
+  #   * DEBUG_INFO_FULL     - line numbers for every instruction, and
+  #                           the docstring (if any) of the function
+  #   * DEBUG_INFO_LINES    - line numbers only
+  #   * DEBUG_INFO_STRIPPED - no line number table; everything is
+  #                           reported at the first line
+
+  if debug_info not in (DEBUG_INFO_FULL,DEBUG_INFO_LINES,DEBUG_INFO_STRIPPED) :
+    raise ValueError( f'unknown debug info level {debug_info!r}' )
+
+  _check_labels( ops, labels )
+
+  # optimization passes rewrite the instruction stream before
+  # anything else sees it. The analysis of the result is then used
+  # for the stack depth
+  #
+  # Errors found after that are reported against the builder 
+  # instruction each one came from. Passes keep the instructions 
+  # they do not change, so these are found by identity, and those
+  # that a pass made have no index
+  builder_ops = ops
+  ops, labels, analysis = run_passes( ops, labels, signature, passes )
+  if passes :
+    origin  = { id(op) : idx for idx, op in enumerate(builder_ops) }
+    origins = [ origin.get( id(op) ) for op in ops ]
+    _check_labels( ops, labels, origins )
+  else :
+    origins = range( len(ops) )
+
   flags     = CO_OPTIMIZED
-  cellvars  = InternArray()
-  constants = InternArray()
-  freevars  = InternArray()
+  cellvars  = InternArray( cellvars )
+  constants = ConstantPool()
+  freevars  = InternArray( freevars )
   names     = InternArray()
   varnames  = InternArray()
 
   # decompose signature
-  arglist             = []
-  positional_defaults = []
-  keyword_defaults    = {}
   positional_count    = 0
+  posonly_count       = 0
   kwonly_count        = 0
 
-  for k,p in signature.parameters.items() :
+  # `co_varnames` lists keyword-only parameters ahead of `*args`,
+  # which `Signature` orders the other way around
+  params = signature.parameters.values()
+  params = [ p for p in params if p.kind <= p.POSITIONAL_OR_KEYWORD ] \
+         + [ p for p in params if p.kind == p.KEYWORD_ONLY ]          \
+         + [ p for p in params if p.kind == p.VAR_POSITIONAL ]        \
+         + [ p for p in params if p.kind == p.VAR_KEYWORD ]
+
+  for p in params :
 
     varnames.insert( p.name )
 
@@ -153,12 +478,10 @@ def assemble(
       flags |= CO_VARARGS 
     elif p.kind == p.KEYWORD_ONLY :
       kwonly_count += 1
-      if p.default is not p.empty :
-        keyword_defaults[p.name] = p.default
     else :
-      if p.default is not p.empty :
-        positional_defaults.append( p.default )
       positional_count += 1
+      if p.kind == p.POSITIONAL_ONLY :
+        posonly_count += 1
 
   # encode op args. Assumes instructions are at most 4 bytes.
   # backward jumps are resolved here, but forward jumps are not
@@ -193,10 +516,17 @@ def assemble(
       oplen += 2*(raw-idx>=0x41)
 
     elif typ == ConstantArg :
+      if isinstance(raw,_WithOuterGlobals) :
+        raise ValueError( f'{raw.fn.__name__!r} needs the globals of a function, so cannot be in a bare code object' )
       arg = constants.insert(raw)
 
     elif typ == FreeVariableArg :
-      arg = freevars.insert(raw)
+      # cell variables are numbered before free variables. All of
+      # the former are declared up front, so their count is known
+      if raw in cellvars :
+        arg = cellvars[raw]
+      else :
+        arg = len(cellvars) + freevars.insert(raw)
 
     elif typ == NameArg :
       arg = names.insert(raw)
@@ -216,20 +546,19 @@ def assemble(
       flags = fop(flags)
 
   expected_length = ip
+  flags = _resolve_generator_flags( flags|code_flags )
   if varnames :
     flags |= CO_NEWLOCALS
-  if not freevars :
+  if not freevars and not cellvars :
     flags |= CO_NOFREE
 
-  # generate bytes and compute stack depth
+  # generate bytes
   code = bytearray()
 
-  se_ins = PASS
-  if stackdepth is None :
-    se = StackEffects({ k:encoded[v][-1] for (k,v) in labels.items() })
-    se_ins = se.insert
-
   lntab = LineNumbering( encoded[0][0] )
+  lntab_add = lntab.add
+  if debug_info == DEBUG_INFO_STRIPPED :
+    lntab_add = PASS
   for line, op, typ, raw, arg, oplen, ip in encoded :
 
     # resolve forward jumps and convert jump targets
@@ -240,10 +569,7 @@ def assemble(
 
     elif typ == RelLabelArg :
       abs = encoded[raw][-1]
-      arg = abs - ip - 1
-    
-    else :
-      abs = raw
+      arg = abs - (ip + oplen)
 
     # write actual opcodes to buffer
     eff_arg = arg or 0
@@ -259,14 +585,28 @@ def assemble(
       raise AssertionError( 'invalid oplen' )
 
     # line numbering
-    lntab.add( line, ip )
+    lntab_add( line, ip )
 
-    # stack effects
-    se_ins( ip, oplen, op, abs, arg, typ )
+  # the encoded output is checked on its own terms, so that any
+  # problem with the instructions or their encoding is reported
+  # against the builder instruction it came from
+  if verify :
+    verify_code( code, { e[-1] : (origins[idx],e[0]) for idx,e in enumerate(encoded) } )
 
   if stackdepth is None :
-    _visualization_hook( name, se )
-    stackdepth = compute_stack_depth( se )
+    stackdepth = analysis.stack_depth
+
+  # the visualization hook is handed the graph of the encoded code,
+  # in which blocks are addressed by byte offset as `dis` shows them,
+  # rather than the one of the analysis, addressed by instruction
+  if _visualization_hook is not PASS :
+    se = StackEffects({ k:encoded[v][-1] for (k,v) in labels.items() })
+    for line, op, typ, raw, arg, oplen, ip in encoded :
+      if typ == AbsLabelArg or typ == RelLabelArg :
+        raw = encoded[raw][-1]
+        arg = 0
+      se.insert( ip, oplen, op, raw, arg, typ )
+    _visualization_hook( name, make_annotated_cfg( se, max_states=analysis.max_states ) )
 
   # build code object
   if len(code) != expected_length :
@@ -274,7 +614,7 @@ def assemble(
 
   co = types.CodeType(
             positional_count
-          , positional_count
+          , posonly_count
           , kwonly_count
           , len(varnames)
           , stackdepth
@@ -291,24 +631,232 @@ def assemble(
           , cellvars.as_tuple()
           )
 
-  # build function object
+  return co
+
+
+##################################################
+#                                                #
+##################################################
+_rebind_info = weakref.WeakKeyDictionary()
+
+def _resolve_global( fglobals, name ) :
+
+  try :
+    return fglobals[ name ]
+  except KeyError :
+    pass
+
+  # mirror the interpreter's choice of builtins for a function
+  # created with these globals
+  fbuiltins = fglobals.get( '__builtins__', builtins )
+  if isinstance(fbuiltins,types.ModuleType) :
+    fbuiltins = vars(fbuiltins)
+
+  try :
+    return fbuiltins[ name ]
+  except KeyError :
+    raise NameError( f'name {name!r} is not defined' ) from None
+
+
+def _bind_globals( ops, fglobals, bind_globals ) :
+
+  bindings = {}
+  result   = []
+  for line, op, typ, raw, fop in ops :
+    if op == LOAD_GLOBAL and (bind_globals is True or raw in bind_globals) :
+      if raw not in bindings :
+        bindings[ raw ] = _resolve_global( fglobals, raw )
+      result.append( (line,LOAD_CONST,ConstantArg,bindings[raw],None) )
+    else :
+      result.append( (line,op,typ,raw,fop) )
+
+  return result, bindings
+
+
+##
+class _WithOuterGlobals( object ) :
+
+  # Stands in, as a constant, for a function that is to run with 
+  # the globals of the function that loads it, which are only 
+  # known once that function is assembled
+
+  __slots__ = ( 'fn', )
+
+  def __init__( self, fn ) :
+    self.fn = fn
+
+  def bind( self, fglobals ) :
+    fn = self.fn
+    bound = types.FunctionType( 
+                fn.__code__
+              , fglobals
+              , fn.__name__
+              , fn.__defaults__
+              , fn.__closure__
+              )
+    bound.__kwdefaults__ = fn.__kwdefaults__
+    bound.__doc__        = fn.__doc__
+    return bound
+
+
+def _bind_outer_globals( ops, fglobals ) :
+
+  if not any( isinstance(raw,_WithOuterGlobals) for _, _, _, raw, _ in ops ) :
+    return ops
+
+  result = []
+  for line, op, typ, raw, fop in ops :
+    if isinstance(raw,_WithOuterGlobals) :
+      raw = raw.bind( fglobals )
+    result.append( (line,op,typ,raw,fop) )
+
+  return result
+
+
+def _move_rebind_info( src, dst ) :
+  info = _rebind_info.pop( src, None )
+  if info is not None :
+    _rebind_info[ dst ] = info
+
+
+def rebind_globals( fn ) :
+
+  # Re-resolves the globals bound into a function made with 
+  # `bind_globals` and `rebindable=True`. If any of them now 
+  # refer to different objects, the function is reassembled and 
+  # its code replaced in place, so that existing references see
+  # the new bindings. Returns whether anything changed
+
+  # a lazy function only has bindings once it is assembled
+  _realize_lazy( fn )
+
+  info = _rebind_info.get( fn )
+  if info is None :
+    raise ValueError( f'{fn!r} was not made with rebindable globals' )
+
+  params, bindings = info
+
+  fglobals = params[ 'fglobals' ]
+  if all( _resolve_global(fglobals,k) is v for k,v in bindings.items() ) :
+    return False
+
+  real = assemble( rebindable=True, **params )
+  fn.__code__ = real.__code__
+  _move_rebind_info( real, fn )
+  _assembled.discard( real )
+
+  return True
+
+
+##################################################
+#                                                #
+##################################################
+# stand-ins made by `assemble_lazy` that have not been called yet,
+# each mapped to the function that assembles its real code. That
+# function does not refer to the stand-in, which would keep it alive
+_lazy = weakref.WeakKeyDictionary()
+
+def _realize_lazy( fn ) :
+  realize = _lazy.get( fn )
+  if realize is not None :
+    realize( fn )
+    _lazy.pop( fn, None )
+
+
+def assemble_lazy( 
+        name
+      , fglobals
+      , filename
+      , ops
+      , closure_values
+      , **params
+      ) :
+
+  # Returns a stand-in function that defers the real work of 
+  # `assemble` until it is first called. The stand-in has a
+  # trivial body that forwards its arguments to a materializer,
+  # but is otherwise built with the same free variables (and 
+  # cells) that the real function will have. On first call, the
+  # real code object is assembled and swapped into the stand-in
+  # so that subsequent calls run it directly, and the builder
+  # state held here becomes garbage. The stand-in's closure cannot
+  # be replaced, so the real code is made to list its free 
+  # variables in the same order, whatever passes do to the ops.
+
   if fglobals is None :
-    fglobals = inspect.currentframe().f_back.f_globals
+    fglobals = sys._getframe(1).f_globals
+
+  cellvars = params.get( 'cellvars', () )
+  freevars = InternArray()
+  for _, _, typ, raw, _ in ops :
+    if typ == FreeVariableArg and raw not in cellvars :
+      freevars.insert( raw )
+  freevars = freevars.as_tuple()
+
+  def realize( fn ) :
+    real = assemble(
+                name              = name
+              , fglobals          = fglobals
+              , filename          = filename
+              , ops               = ops
+              , closure_values    = closure_values
+              , freevars          = freevars
+              , **params
+              )
+    _move_rebind_info( real, fn )
+    fn.__code__       = real.__code__
+    fn.__defaults__   = real.__defaults__
+    fn.__kwdefaults__ = real.__kwdefaults__
+    fn.__doc__        = real.__doc__
+    _assembled.discard( real )
+
+  def materialize( *args, **kwargs ) :
+    _realize_lazy( fn )
+    return fn( *args, **kwargs )
+
+  flags = CO_OPTIMIZED|CO_NEWLOCALS|CO_VARARGS|CO_VARKEYWORDS
+  if not freevars :
+    flags |= CO_NOFREE
+
+  stub = types.CodeType(
+              0
+            , 0
+            , 0
+            , 2
+            , 3
+            , flags
+            , bytes((
+                  LOAD_CONST        , 0
+                , LOAD_FAST         , 0
+                , LOAD_FAST         , 1
+                , CALL_FUNCTION_EX  , 1
+                , RETURN_VALUE      , 0
+                ))
+            , (materialize,)
+            , ()
+            , ('args','kwargs')
+            , filename
+            , name
+            , ops[0][0] if ops else 1
+            , b''
+            , freevars
+            , ()
+            )
 
   closure = []
-  for k in co.co_freevars :
+  for k in freevars :
     closure.append(_make_closure(closure_values[k]))
 
   fn = types.FunctionType( 
-              co
+              stub
             , fglobals
             , name
-            , tuple(positional_defaults) or None
+            , None
             , tuple(closure) or None
             )
 
-  if keyword_defaults :
-    fn.__kwdefaults__ = keyword_defaults
+  _assembled.add( fn )
+  _lazy[ fn ] = realize
 
   return fn
 
@@ -1,21 +1,35 @@
 from . assemble import *
 from . constants import *
+from . passes import *
 from . utils import *
 
-from inspect import Parameter, Signature
+from . analysis import Analysis
+from . assemble import _WithOuterGlobals
 
+import collections
+import functools
 import itertools
 import opcode
+import types
 
 __all__ = [ 
     'EmittersMixin'
   , 'FunctionBuilder'
+  , 'SwitchInfo'
   ]
 
 ##################################################
 #                                                #
 ##################################################
 UnknownFilename   = '?????'
+InlineMaxSize     = 64
+UnrollMaxSize     = 16
+SwitchLinearMax   = 4
+SwitchDenseMin    = 0.5
+
+# how a switch was lowered, and the mean number of comparisons 
+# made to reach each case
+SwitchInfo = collections.namedtuple( 'SwitchInfo', 'lowering comparisons' )
 
 ##################################################
 #                                                #
@@ -96,6 +110,63 @@ def _add_emitter( cls, name, code ) :
 
   setattr( cls, emitter.__name__, emitter )
 
+  return emitter
+
+def _lookup_emitter( cls, name ) :
+
+  # emitters are created the first time they are asked for
+  # rather than at import. Once added to the class, normal
+  # attribute lookup finds them and `__getattr__` is no longer
+  # involved
+  if name.startswith( 'emit_' ) and name.islower() :
+    opname = name[5:].upper()
+    code = opcode.opmap.get( opname )
+    if code is not None :
+      return _add_emitter( cls, opname, code )
+
+
+def _arg_type( code ) :
+
+  if code < opcode.HAVE_ARGUMENT :
+    return NilArg
+  if code in opcode.hasconst :
+    return ConstantArg
+  if code in opcode.hasfree :
+    return FreeVariableArg
+  if code in opcode.hasjabs :
+    return AbsLabelArg
+  if code in opcode.hasjrel :
+    return RelLabelArg
+  if code in opcode.haslocal :
+    return LocalArg
+  if code in opcode.hasname :
+    return NameArg
+  return GenericArg
+
+
+_not_inlinable = frozenset(( 
+    YIELD_VALUE, YIELD_FROM, LOAD_NAME, STORE_NAME, DELETE_NAME
+  ))
+
+def _can_inline( builder ) :
+
+  # A body can be spliced into another function when each of its 
+  # returns leaves only the return value on the stack and no block
+  # is active, since `RETURN_VALUE` would otherwise be responsible
+  # for unwinding them
+
+  ops = builder._op_buffer
+  if builder._cellvars or any( op in _not_inlinable for _, op, *_ in ops ) :
+    return False
+
+  for blk in Analysis( ops, builder._labels ).cfg.values() :
+    if blk.instructions and blk.instructions[-1][2] == RETURN_VALUE :
+      for s, f, _ in blk.values :
+        if s != 0 or f :
+          return False
+
+  return True
+
 
 ##
 class EmittersMixin( object ) :
@@ -136,16 +207,23 @@ class EmittersMixin( object ) :
   def emit_label( self, label=None ) :
     return self._emit_label( label )
 
-##
-for name,code in opcode.opmap.items() :
-  _add_emitter(EmittersMixin,name,code)
+  def __getattr__( self, name ) :
+    emitter = _lookup_emitter( EmittersMixin, name )
+    if emitter is None :
+      raise AttributeError( f'{self.__class__.__name__!r} object has no attribute {name!r}' )
+    return emitter.__get__( self, self.__class__ )
+
+  def __dir__( self ) :
+    names = set( super().__dir__() )
+    names.update( 'emit_' + name.lower() for name in opcode.opmap )
+    return sorted( names )
 
 ##################################################
 #                                                #
 ##################################################
 class FunctionBuilder( EmittersMixin ) :
 
-  def __init__( self, first_line_number=1 ) :
+  def __init__( self, first_line_number=1, debug_info=DEBUG_INFO_FULL ) :
     self._positional     = []
     self._keyword_only   = []
     self._agg_positional = []
@@ -153,36 +231,171 @@ class FunctionBuilder( EmittersMixin ) :
     self._op_buffer      = []
     self._labels         = {}
     self._label_seq      = itertools.count(1)
+    self._local_seq      = itertools.count(1)
     self._closure        = {}
+    self._cellvars       = []
+    self._code_flags     = 0
     self._line_number    = first_line_number
+    self._debug_info     = debug_info
 
   def __len__( self ) :
     return len(self._op_buffer)
 
+  @classmethod
+  def from_code( cls, fn_or_code ) :
+
+    # Decodes an existing function (or code object) into a new 
+    # builder. Jump offsets become labels named for the offset
+    # they target, and the signature, cell variables, closure
+    # values and kind of function (coroutine, async generator) of
+    # the original are carried over
+
+    import dis
+
+    if isinstance(fn_or_code,types.CodeType) :
+      fn = None
+      co = fn_or_code
+    else :
+      fn = fn_or_code
+      co = fn.__code__
+
+    self = cls( co.co_firstlineno )
+    self._declare_parameters( co, fn )
+    self._code_flags = co.co_flags & (CO_COROUTINE|CO_ASYNC_GENERATOR|CO_ITERABLE_COROUTINE)
+
+    for name in co.co_cellvars :
+      self.add_cell_var( name )
+
+    if fn is not None and fn.__closure__ :
+      for name, cell in zip( co.co_freevars, fn.__closure__ ) :
+        try :
+          self.set_closure_value( name, cell.cell_contents )
+        except ValueError :
+          pass
+
+    for ins in dis.get_instructions( co ) :
+
+      if ins.is_jump_target :
+        self.emit_label( f'offset_{ins.offset}' )
+
+      if ins.starts_line is not None :
+        self.set_line_number( ins.starts_line )
+
+      if ins.opcode == EXTENDED_ARG :
+        continue
+
+      typ = _arg_type( ins.opcode )
+      if typ == NilArg :
+        raw = None
+      elif typ == AbsLabelArg or typ == RelLabelArg :
+        raw = f'offset_{ins.argval}'
+      elif typ == GenericArg :
+        raw = ins.arg
+      else :
+        raw = ins.argval
+
+      self._insert_op( ins.opcode, typ, raw, fop(ins.opcode) )
+
+    return self
+
+  def _declare_parameters( self, co, fn ) :
+
+    from inspect import Parameter
+
+    if fn is not None :
+      defaults   = fn.__defaults__ or ()
+      kwdefaults = fn.__kwdefaults__ or {}
+    else :
+      defaults   = ()
+      kwdefaults = {}
+
+    names = co.co_varnames
+    first_default = co.co_argcount - len(defaults)
+
+    for i in range( co.co_argcount ) :
+      kwargs = {}
+      if i >= first_default :
+        kwargs[ 'default' ] = defaults[ i - first_default ]
+      if i < co.co_posonlyargcount :
+        self._positional.append( Parameter( names[i], Parameter.POSITIONAL_ONLY, **kwargs ) )
+      else :
+        self.add_positional_arg( names[i], **kwargs )
+
+    idx = co.co_argcount
+    for name in names[ idx:idx+co.co_kwonlyargcount ] :
+      kwargs = {}
+      if name in kwdefaults :
+        kwargs[ 'default' ] = kwdefaults[ name ]
+      self.add_keyword_only_arg( name, **kwargs )
+
+    idx += co.co_kwonlyargcount
+    if co.co_flags & CO_VARARGS :
+      self.add_agg_positional_arg( names[idx] )
+      idx += 1
+    if co.co_flags & CO_VARKEYWORDS :
+      self.add_agg_keyword_arg( names[idx] )
+
+  # `inspect` is comparatively expensive to import, so it is
+  # imported at the point of use rather than with this module
+
   def add_positional_arg( self, name, **kwargs ) :
+    from inspect import Parameter
     self._positional.append( Parameter( name, Parameter.POSITIONAL_OR_KEYWORD, **kwargs ) )
 
   def add_keyword_only_arg( self, name, **kwargs ) :
+    from inspect import Parameter
     self._keyword_only.append( Parameter( name, Parameter.KEYWORD_ONLY, **kwargs ) )
 
   def add_agg_positional_arg( self, name, **kwargs ) :
+    from inspect import Parameter
     self._agg_positional.append( Parameter( name, Parameter.VAR_POSITIONAL, **kwargs ) )
 
   def add_agg_keyword_arg( self, name, **kwargs ) :
+    from inspect import Parameter
     self._agg_keyword.append( Parameter( name, Parameter.VAR_KEYWORD, **kwargs ) )
 
+  def add_cell_var( self, name ) :
+    # locals that are accessed through `*_DEREF` instructions
+    # and can be captured by nested functions
+    if name not in self._cellvars :
+      self._cellvars.append( name )
+
   def set_closure_value( self, key, value ) :
     self._closure[ key ] = value
 
+  # A function is a coroutine, or async generator, if it uses any
+  # of the async instructions. The `coroutine` and `async_generator`
+  # options of `make` mark one that does not, such as 
+  # `async def f(): return 1`
+
+  def _flags_for( self, coroutine, async_generator ) :
+    flags = self._code_flags
+    if coroutine :
+      flags |= CO_COROUTINE
+    if async_generator :
+      flags |= CO_ASYNC_GENERATOR
+    return flags
+
   def make_label( self, head='auto' ) :
     idx = next(self._label_seq)
     return f'{head}_{idx}'
 
+  def make_temp_local( self, head='temp' ) :
+    # a fresh local for intermediate values. The name is not an
+    # identifier, so cannot clash with any local of the source
+    idx = next(self._local_seq)
+    return f'.{head}_{idx}'
+
+  # when debug info is stripped, every instruction is recorded
+  # against the first line
+
   def inc_line_number( self, delta=1 ) :
-    self._line_number += delta
+    if self._debug_info != DEBUG_INFO_STRIPPED :
+      self._line_number += delta
 
   def set_line_number( self, value ) :
-    self._line_number = value
+    if self._debug_info != DEBUG_INFO_STRIPPED :
+      self._line_number = value
 
   def _insert_op( self, *args ) :
     self._op_buffer.append( (self._line_number,*args) )
@@ -202,15 +415,58 @@ class FunctionBuilder( EmittersMixin ) :
         , docstring         = None
         , stackdepth        = None
         , filename          = UnknownFilename
+        , lazy              = False
+        , passes            = ()
+        , bind_globals      = ()
+        , rebindable        = False
+        , instrument        = False
+        , profile           = None
+        , debug_info        = None
+        , verify            = True
+        , coroutine         = False
+        , async_generator   = False
         ) :
 
     if signature is None :
-      signature = Signature( 
-                      self._positional
-                    + self._keyword_only
-                    + self._agg_positional
-                    + self._agg_keyword
-                    )
+      signature = self._signature()
+
+    if debug_info is None :
+      debug_info = self._debug_info
+
+    # an instrumented build counts block entries and branch 
+    # directions into a `Profile` (see `profile_of`), which a later
+    # build of the same instructions can use to reorder its blocks,
+    # so that hot successors fall through and blocks that were never
+    # entered move to the end. Cold blocks are not outlined
+    passes = list(passes)
+    if instrument or profile is not None :
+      passes.insert( 0, label_blocks )
+    if instrument :
+      passes.insert( 1, functools.partial( instrument_blocks, profile=Profile() ) )
+    if profile is not None :
+      passes.append( functools.partial( layout_blocks, weights=profile.weights() ) )
+
+    if lazy :
+      # the builder may continue to be modified after this 
+      # call, so snapshot everything that assembly will need
+      return assemble_lazy(
+                  name              = name
+                , fglobals          = fglobals
+                , signature         = signature
+                , docstring         = docstring
+                , stackdepth        = stackdepth
+                , filename          = filename
+                , ops               = list(self._op_buffer)
+                , labels            = dict(self._labels)
+                , closure_values    = dict(self._closure)
+                , passes            = tuple(passes)
+                , bind_globals      = bind_globals
+                , rebindable        = rebindable
+                , cellvars          = tuple(self._cellvars)
+                , debug_info        = debug_info
+                , verify            = verify
+                , code_flags        = self._flags_for( coroutine, async_generator )
+                )
 
     return assemble(      
                 name              = name
@@ -222,6 +478,388 @@ class FunctionBuilder( EmittersMixin ) :
               , ops               = self._op_buffer
               , labels            = self._labels
               , closure_values    = self._closure
+              , passes            = passes
+              , bind_globals      = bind_globals
+              , rebindable        = rebindable
+              , cellvars          = self._cellvars
+              , debug_info        = debug_info
+              , verify            = verify
+              , code_flags        = self._flags_for( coroutine, async_generator )
+              )
+
+  def make_code( 
+          self
+        , name
+        , *
+        , signature         = None
+        , stackdepth        = None
+        , filename          = UnknownFilename
+        , passes            = ()
+        , debug_info        = None
+        , verify            = True
+        , coroutine         = False
+        , async_generator   = False
+        ) :
+
+    if signature is None :
+      signature = self._signature()
+
+    if debug_info is None :
+      debug_info = self._debug_info
+
+    return assemble_code(
+                name              = name
+              , signature         = signature
+              , stackdepth        = stackdepth
+              , filename          = filename
+              , ops               = self._op_buffer
+              , labels            = self._labels
+              , passes            = passes
+              , cellvars          = self._cellvars
+              , debug_info        = debug_info
+              , verify            = verify
+              , code_flags        = self._flags_for( coroutine, async_generator )
+              )
+
+  def emit_nested_function( self, builder, name, *, qualname=None, signature=None, **kwargs ) :
+
+    # Emits code creating a function from another builder at run
+    # time, as a `def` statement nested in this function would. 
+    # Any free variables of the inner function are captured from
+    # the cell (or free) variables of this one with the same name
+
+    if signature is None :
+      signature = builder._signature()
+    co = builder.make_code( name, signature=signature, **kwargs )
+    positional_defaults, keyword_defaults = signature_defaults( signature )
+
+    flags = 0
+
+    if positional_defaults :
+      self.emit_load_const( positional_defaults )
+      flags |= MAKE_FUNCTION_DEFAULTS
+
+    if keyword_defaults :
+      for value in keyword_defaults.values() :
+        self.emit_load_const( value )
+      self.emit_load_const( tuple(keyword_defaults) )
+      self.emit_build_const_key_map( len(keyword_defaults) )
+      flags |= MAKE_FUNCTION_KWDEFAULTS
+
+    if co.co_freevars :
+      for k in co.co_freevars :
+        self.emit_load_closure( k )
+      self.emit_build_tuple( len(co.co_freevars) )
+      flags |= MAKE_FUNCTION_CLOSURE
+
+    self.emit_load_const( co )
+    self.emit_load_const( qualname or name )
+    return self.emit_make_function( flags )
+
+  def emit_inline( self, builder, name, argc=None, *, max_size=InlineMaxSize, fglobals=None ) :
+
+    # Splices the body of another builder into this one, in place of
+    # a call to the function it would make. The `argc` positional 
+    # arguments are expected on the stack and are replaced by the
+    # return value, as for a call. Locals and labels of the inlined
+    # body are renamed so as not to collide with those of this 
+    # function, each `RETURN_VALUE` becomes a jump to the end of the
+    # body, and closure values are merged into those of this builder.
+    # Global names are resolved against the globals of the function
+    # this builder makes.
+    #
+    # Bodies larger than `max_size` instructions, and those that 
+    # cannot be inlined (generators, cell variables, or a return 
+    # from inside a block) are instead made into a function named
+    # `name` and called. Its globals are `fglobals` if given, and
+    # otherwise those of the function this builder makes, once it
+    # is made. Returns whether the body was inlined
+
+    params = builder._signature().parameters.values()
+    positional = [ p for p in params if p.kind <= p.POSITIONAL_OR_KEYWORD ]
+    if argc is None :
+      argc = len(positional)
+
+    required = sum( 1 for p in positional if p.default is p.empty )
+    if not required <= argc <= len(positional) :
+      raise ValueError( f'{name} takes {len(positional)} positional arguments but {argc} were given' )
+    if any( p.kind == p.KEYWORD_ONLY and p.default is p.empty for p in params ) :
+      raise ValueError( f'{name} has keyword-only arguments without defaults' )
+
+    if len(builder) > max_size or not _can_inline( builder ) :
+      if fglobals is None :
+        fn = _WithOuterGlobals( builder.make( name, {} ) )
+      else :
+        fn = builder.make( name, fglobals )
+      self.emit_build_tuple( argc )
+      self.emit_load_const( fn )
+      self.emit_rot_two()
+      self.emit_call_function_ex( 0 )
+      return False
+
+    prefix = self.make_temp_local( 'inline' ) + '_'
+    line   = self._line_number
+
+    def store( p ) :
+      self.emit_store_fast( prefix + p.name )
+
+    # bind arguments, working down from the top of the stack
+    for p in reversed(positional[argc:]) :
+      self.emit_load_const( p.default )
+      store( p )
+    for p in reversed(positional[:argc]) :
+      store( p )
+    for p in params :
+      if p.kind == p.KEYWORD_ONLY :
+        self.emit_load_const( p.default )
+        store( p )
+      elif p.kind == p.VAR_POSITIONAL :
+        self.emit_load_const( () )
+        store( p )
+      elif p.kind == p.VAR_KEYWORD :
+        self.emit_build_map( 0 )
+        store( p )
+
+    for key, value in builder._closure.items() :
+      self.set_closure_value( prefix + key, value )
+
+    done = prefix + 'return'
+    base = len(self._op_buffer)
+    ops  = builder._op_buffer
+    if ops and ops[-1][1] == RETURN_VALUE :
+      ops = ops[:-1]
+
+    for _, op, typ, raw, f in ops :
+      if op == RETURN_VALUE :
+        op, typ, raw, f = JUMP_ABSOLUTE, AbsLabelArg, done, fop(JUMP_ABSOLUTE)
+      elif typ == AbsLabelArg or typ == RelLabelArg or typ == LocalArg :
+        raw = prefix + raw
+      elif typ == FreeVariableArg and raw in builder._closure :
+        raw = prefix + raw
+      self._op_buffer.append( (line, op, typ, raw, f) )
+
+    self._emit_label( done )
+    end = len(self._op_buffer)
+    for label, idx in builder._labels.items() :
+      self._labels[ prefix + label ] = min( base + idx, end )
+
+    return True
+
+  def emit_unrolled_loop( self, values, body, target=None, *, unroll=None, max_unroll=UnrollMaxSize ) :
+
+    # Emits `body` once for each of a sequence of values known when
+    # the code is generated, as the body of `for target in values`
+    # would run. The body is called as `body(builder, load)` where 
+    # `load()` emits code pushing the current element: a constant 
+    # when the loop is fully unrolled, otherwise the local `target`. 
+    # The body must leave the stack as it found it.
+    #
+    # With `unroll=n`, the body is emitted `n` times inside a loop
+    # over groups of `n` values, and once more for each of the 
+    # values left over. Without it, sequences of up to `max_unroll`
+    # values are fully unrolled and longer ones fall back to a 
+    # `FOR_ITER` loop
+
+    values = tuple(values)
+    if target is None :
+      target = self.make_temp_local( 'element' )
+
+    def load_const( value ) :
+      return lambda : self.emit_load_const( value )
+
+    def load_target() :
+      return self.emit_load_fast( target )
+
+    if unroll is None :
+      unroll = 1 if len(values) > max_unroll else len(values)
+
+    tail = values
+    if 0 < unroll < len(values) :
+
+      # each iteration of the loop unpacks a group onto the stack,
+      # first element on top
+      split = len(values) - len(values) % unroll
+      head, tail = values[:split], values[split:]
+      groups = tuple( head[i:i+unroll] for i in range(0,split,unroll) )
+
+      top  = self.make_label( 'unroll' )
+      done = self.make_label( 'unroll' )
+      self.emit_load_const( groups if unroll > 1 else head )
+      self.emit_get_iter()
+      self.emit_label( top )
+      self.emit_for_iter( done )
+      if unroll > 1 :
+        self.emit_unpack_sequence( unroll )
+      for _ in range(unroll) :
+        self.emit_store_fast( target )
+        body( self, load_target )
+      self.emit_jump_absolute( top )
+      self.emit_label( done )
+
+    for value in tail :
+      body( self, load_const(value) )
+
+  def emit_switch( self, cases, default, *, lowering=None ) :
+
+    # Pops a value off the stack and jumps to the label that `cases`
+    # maps it to, or to `default` if there is none. The lowering is
+    # one of:
+    #
+    #   * 'linear' - an equality test against each case in turn
+    #   * 'binary' - a balanced binary search over integer cases. 
+    #                The value must be orderable against them
+    #   * 'table'  - a range check, then a tuple indexed by the value
+    #                less the smallest case, holding the index of its
+    #                label. Cases must be integers. Values that are 
+    #                not exactly `int`, such as 3.0, are looked up as
+    #                with 'dict'
+    #   * 'dict'   - a dict lookup giving the index of the label.
+    #                Values must be hashable
+    #
+    # Bytecode has no indirect jump, so 'table' and 'dict' go on to
+    # reach the label by a binary search over label indices, which 
+    # costs comparisons in the number of distinct labels rather than
+    # of cases.
+    #
+    # By default, up to `SwitchLinearMax` cases are tested linearly.
+    # Integer cases filling at least `SwitchDenseMin` of their range
+    # use a table, sparser ones are searched, and anything else goes
+    # through a dict. Returns a `SwitchInfo`
+
+    ints = bool(cases) and all( type(k) is int for k in cases )
+
+    if lowering is None :
+      if len(cases) <= SwitchLinearMax :
+        lowering = 'linear'
+      elif ints and len(cases) >= SwitchDenseMin * (max(cases) - min(cases) + 1) :
+        lowering = 'table'
+      elif ints :
+        lowering = 'binary'
+      else :
+        lowering = 'dict'
+
+    value = self.make_temp_local( 'switch' )
+    self.emit_store_fast( value )
+
+    def test( key, op, label ) :
+      self.emit_load_fast( value )
+      self.emit_load_const( key )
+      self.emit_compare_op( op )
+      self.emit_pop_jump_if_true( label )
+
+    counts = []
+
+    if lowering == 'linear' :
+      for n, (key, label) in enumerate(cases.items(),1) :
+        test( key, COMPARE_EQ, label )
+        counts.append( n )
+      self.emit_jump_absolute( default )
+
+    elif lowering == 'binary' :
+
+      keys = sorted( cases )
+
+      def search( lo, hi, depth ) :
+        if hi - lo <= 2 :
+          for n, key in enumerate(keys[lo:hi],1) :
+            test( key, COMPARE_EQ, cases[key] )
+            counts.append( depth+n )
+          self.emit_jump_absolute( default )
+          return
+        mid = (lo+hi) // 2
+        left = self.make_label( 'switch' )
+        test( keys[mid], COMPARE_LT, left )
+        search( mid, hi, depth+1 )
+        self.emit_label( left )
+        search( lo, mid, depth+1 )
+
+      search( 0, len(keys), 0 )
+
+    elif lowering == 'table' or lowering == 'dict' :
+
+      targets = list( dict.fromkeys( cases.values() ) )
+      index = { key : targets.index(label) for key, label in cases.items() }
+      per_target = collections.Counter( index.values() )
+
+      def lookup() :
+        self.emit_load_const( index.get )
+        self.emit_load_fast( value )
+        self.emit_load_const( -1 )
+        self.emit_call_function( 2 )
+
+      if lowering == 'table' :
+        if not ints :
+          raise ValueError( 'table switches need integer cases' )
+        lo, hi = min(cases), max(cases)
+        table = tuple( index.get( k, -1 ) for k in range( lo, hi+1 ) )
+        other = self.make_label( 'switch' )
+        found = self.make_label( 'switch' )
+        self.emit_load_const( type )
+        self.emit_load_fast( value )
+        self.emit_call_function( 1 )
+        self.emit_load_const( int )
+        self.emit_compare_op( COMPARE_IS )
+        self.emit_pop_jump_if_false( other )
+        test( lo, COMPARE_LT, default )
+        test( hi, COMPARE_GT, default )
+        self.emit_load_const( table )
+        self.emit_load_fast( value )
+        self.emit_load_const( lo )
+        self.emit_binary_subtract()
+        self.emit_binary_subscr()
+        self.emit_jump_forward( found )
+        self.emit_label( other )
+        lookup()
+        self.emit_label( found )
+        first = 4
+      else :
+        lookup()
+        first = 1
+      self.emit_store_fast( value )
+      test( 0, COMPARE_LT, default )
+
+      def search( lo, hi, depth ) :
+        if hi - lo == 1 :
+          counts.extend( [depth] * per_target[lo] )
+          self.emit_jump_absolute( targets[lo] )
+          return
+        mid = (lo+hi) // 2
+        left = self.make_label( 'switch' )
+        test( mid, COMPARE_LT, left )
+        search( mid, hi, depth+1 )
+        self.emit_label( left )
+        search( lo, mid, depth+1 )
+
+      if targets :
+        search( 0, len(targets), first )
+      else :
+        self.emit_jump_absolute( default )
+
+    else :
+      raise ValueError( f'unknown switch lowering {lowering!r}' )
+
+    return SwitchInfo( lowering, sum(counts) / len(counts) if counts else 0.0 )
+
+  def emit_expression( self, expr, fold=True ) :
+    # see `expression.emit_expression`
+    from . expression import emit_expression
+    return emit_expression( self, expr, fold )
+
+  def _parameter_names( self ) :
+    return { p.name for p in self._signature().parameters.values() }
+
+  def _local_names( self ) :
+    names = self._parameter_names()
+    names.update( raw for _, _, typ, raw, _ in self._op_buffer if typ == LocalArg )
+    return names
+
+  def _signature( self ) :
+    from inspect import Signature
+    return Signature( 
+                self._positional
+              + self._agg_positional
+              + self._keyword_only
+              + self._agg_keyword
               )
 
 
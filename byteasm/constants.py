@@ -10,6 +10,14 @@ CO_VARKEYWORDS    = 0x0008
 CO_NESTED         = 0x0010
 CO_GENERATOR      = 0x0020
 CO_NOFREE         = 0x0040
+CO_COROUTINE      = 0x0080
+CO_ITERABLE_COROUTINE = 0x0100
+CO_ASYNC_GENERATOR    = 0x0200
+
+MAKE_FUNCTION_DEFAULTS    = 0x01
+MAKE_FUNCTION_KWDEFAULTS  = 0x02
+MAKE_FUNCTION_ANNOTATIONS = 0x04
+MAKE_FUNCTION_CLOSURE     = 0x08
 
 COMPARE_LT        = opcode.cmp_op.index( '<' )
 COMPARE_LE        = opcode.cmp_op.index( '<=' )
@@ -32,6 +40,10 @@ FreeVariableArg   , \
 NameArg           , \
 LocalArg          = range(8)
 
+DEBUG_INFO_STRIPPED = 'stripped'
+DEBUG_INFO_LINES    = 'lines'
+DEBUG_INFO_FULL     = 'full'
+
 IP_START          = -1
 IP_END            = 0xFFFFFFFF
 IP_EXCEPT         = 0xFFFFFFFE
@@ -0,0 +1,342 @@
+from . constants import *
+from . utils import *
+
+import ast
+import copy
+import operator
+
+__all__ = [
+    'emit_expression'
+  , 'fold_constants'
+  ]
+
+##################################################
+#                                                #
+##################################################
+_binary_ops = {
+    ast.Add       : ('binary_add'             , operator.add      )
+  , ast.Sub       : ('binary_subtract'        , operator.sub      )
+  , ast.Mult      : ('binary_multiply'        , operator.mul      )
+  , ast.MatMult   : ('binary_matrix_multiply' , operator.matmul   )
+  , ast.Div       : ('binary_true_divide'     , operator.truediv  )
+  , ast.FloorDiv  : ('binary_floor_divide'    , operator.floordiv )
+  , ast.Mod       : ('binary_modulo'          , operator.mod      )
+  , ast.Pow       : ('binary_power'           , operator.pow      )
+  , ast.LShift    : ('binary_lshift'          , operator.lshift   )
+  , ast.RShift    : ('binary_rshift'          , operator.rshift   )
+  , ast.BitAnd    : ('binary_and'             , operator.and_     )
+  , ast.BitOr     : ('binary_or'              , operator.or_      )
+  , ast.BitXor    : ('binary_xor'             , operator.xor      )
+  }
+
+_unary_ops = {
+    ast.UAdd      : ('unary_positive'         , operator.pos      )
+  , ast.USub      : ('unary_negative'         , operator.neg      )
+  , ast.Invert    : ('unary_invert'           , operator.invert   )
+  , ast.Not       : ('unary_not'              , operator.not_     )
+  }
+
+_compare_ops = {
+    ast.Lt        : (COMPARE_LT               , operator.lt       )
+  , ast.LtE       : (COMPARE_LE               , operator.le       )
+  , ast.Eq        : (COMPARE_EQ               , operator.eq       )
+  , ast.NotEq     : (COMPARE_NE               , operator.ne       )
+  , ast.Gt        : (COMPARE_GT               , operator.gt       )
+  , ast.GtE       : (COMPARE_GE               , operator.ge       )
+  , ast.Is        : (COMPARE_IS               , operator.is_      )
+  , ast.IsNot     : (COMPARE_IS_NOT           , operator.is_not   )
+  , ast.In        : (COMPARE_IN               , (lambda a,b : a in b)     )
+  , ast.NotIn     : (COMPARE_NOT_IN           , (lambda a,b : a not in b) )
+  }
+
+# folding is limited to results of a modest size, as the interpreter's
+# own constant folding is
+MaxFoldedIntBits   = 128
+MaxFoldedLength    = 4096
+
+
+##################################################
+#                                                #
+##################################################
+def _constant( node ) :
+  return isinstance(node,ast.Constant)
+
+def _small_enough( value ) :
+  if isinstance(value,int) :
+    return value.bit_length() <= MaxFoldedIntBits
+  if isinstance(value,(str,bytes,tuple,frozenset)) :
+    return len(value) <= MaxFoldedLength
+  return True
+
+def _safe_to_fold( op, a, b ) :
+
+  # rules out operations whose result could be huge before they
+  # are attempted
+  if op is ast.Pow and isinstance(a,int) and isinstance(b,int) and b > 0 :
+    return a.bit_length() * b <= MaxFoldedIntBits
+  if op is ast.LShift and isinstance(a,int) and isinstance(b,int) :
+    return 0 <= b <= MaxFoldedIntBits
+  if op is ast.Mult :
+    for seq, n in ((a,b),(b,a)) :
+      if isinstance(seq,(str,bytes,tuple)) and isinstance(n,int) :
+        return n * len(seq) <= MaxFoldedLength
+  return True
+
+def _fold( node, f, *args ) :
+  try :
+    value = f( *args )
+  except Exception :
+    return node
+  if not _small_enough( value ) :
+    return node
+  return ast.copy_location( ast.Constant( value=value ), node )
+
+
+class _Folder( ast.NodeTransformer ) :
+
+  def visit_BinOp( self, node ) :
+    node = self.generic_visit( node )
+    if _constant(node.left) and _constant(node.right) :
+      a, b = node.left.value, node.right.value
+      if _safe_to_fold( type(node.op), a, b ) :
+        return _fold( node, _binary_ops[type(node.op)][1], a, b )
+    return node
+
+  def visit_UnaryOp( self, node ) :
+    node = self.generic_visit( node )
+    if _constant(node.operand) :
+      return _fold( node, _unary_ops[type(node.op)][1], node.operand.value )
+    return node
+
+  def visit_Compare( self, node ) :
+    node = self.generic_visit( node )
+    if len(node.ops) == 1 and _constant(node.left) and _constant(node.comparators[0]) :
+      f = _compare_ops[type(node.ops[0])][1]
+      return _fold( node, f, node.left.value, node.comparators[0].value )
+    return node
+
+  def visit_BoolOp( self, node ) :
+
+    # leading constants either decide the result or drop out
+    node = self.generic_visit( node )
+    is_and = isinstance(node.op,ast.And)
+    values = list(node.values)
+    while len(values) > 1 and _constant(values[0]) :
+      if bool(values[0].value) != is_and :
+        return values[0]
+      values.pop(0)
+    if len(values) == 1 :
+      return values[0]
+    node.values = values
+    return node
+
+  def visit_Tuple( self, node ) :
+    node = self.generic_visit( node )
+    if all( _constant(e) for e in node.elts ) :
+      return _fold( node, tuple_from_args, *(e.value for e in node.elts) )
+    return node
+
+  def visit_IfExp( self, node ) :
+    node = self.generic_visit( node )
+    if _constant(node.test) :
+      return node.body if node.test.value else node.orelse
+    return node
+
+
+def fold_constants( node ) :
+
+  # Returns a copy of an expression with operations on constants 
+  # evaluated ahead of time. Operations that raise are left to 
+  # raise at run time
+  return _Folder().visit( copy.deepcopy( node ) )
+
+
+##################################################
+#                                                #
+##################################################
+def _operands( node ) :
+  if isinstance(node,ast.BinOp) :
+    return node.left, node.right
+  return node.left, node.comparators[0]
+
+def _index( node ) :
+  # `ast.Index` wraps subscripts before python 3.9
+  sl = node.slice
+  if isinstance(sl,ast.Index) :
+    return sl.value
+  if isinstance(sl,ast.expr) :
+    return sl
+  raise ValueError( 'slices are not supported in expressions' )
+
+
+class _Emitter( object ) :
+
+  def __init__( self, builder ) :
+    self.b = builder
+    self.fast = builder._local_names()
+    self.deref = set( builder._cellvars ) | set( builder._closure )
+    # other locals may be unbound, and loading one raises. The
+    # parameters are bound on entry, unless the builder deletes them
+    self.bound = builder._parameter_names() - {
+        raw for _, op, _, raw, _ in builder._op_buffer if op == DELETE_FAST
+      }
+
+  def is_pure( self, node ) :
+    # evaluating the node runs no code, and nothing else can change
+    # its value, so it may be evaluated later than written
+    if isinstance(node,ast.Name) :
+      return node.id in self.bound and node.id not in self.deref
+    if isinstance(node,ast.Tuple) :
+      return all( self.is_pure(e) for e in node.elts )
+    return isinstance(node,ast.Constant)
+
+  def swaps( self, left, right ) :
+    # Sethi-Ullman: the operand needing more stack goes first, so
+    # that the other is not held on the stack while it is evaluated
+    return self.is_pure( left ) and self.need( right ) > self.need( left )
+
+  def need( self, node ) :
+
+    # the number of stack slots needed to evaluate a node, with its
+    # operands evaluated in the order chosen by `swaps`
+
+    if isinstance(node,(ast.BinOp,ast.Compare)) :
+      left, right = _operands( node )
+      l, r = self.need(left), self.need(right)
+      if self.swaps( left, right ) :
+        return max( r, l+1 )
+      return max( l, r+1 )
+
+    if isinstance(node,ast.UnaryOp) :
+      return self.need( node.operand )
+
+    if isinstance(node,ast.BoolOp) :
+      return max( self.need(v) for v in node.values )
+
+    if isinstance(node,ast.IfExp) :
+      return max( self.need(node.test), self.need(node.body), self.need(node.orelse) )
+
+    if isinstance(node,ast.Attribute) :
+      return self.need( node.value )
+
+    if isinstance(node,ast.Subscript) :
+      return max( self.need(node.value), 1+self.need(_index(node)) )
+
+    if isinstance(node,ast.Call) :
+      return max( i+self.need(n) for i,n in enumerate([node.func]+node.args) )
+
+    if isinstance(node,ast.Tuple) :
+      return max( (i+self.need(n) for i,n in enumerate(node.elts)), default=1 )
+
+    return 1
+
+  def emit( self, node ) :
+    method = getattr( self, 'emit_' + type(node).__name__, None )
+    if method is None :
+      raise ValueError( f'unsupported expression: {type(node).__name__}' )
+    method( node )
+
+  def emit_Constant( self, node ) :
+    self.b.emit_load_const( node.value )
+
+  def emit_Name( self, node ) :
+    if node.id in self.deref :
+      self.b.emit_load_deref( node.id )
+    elif node.id in self.fast :
+      self.b.emit_load_fast( node.id )
+    else :
+      self.b.emit_load_global( node.id )
+
+  def emit_operands( self, left, right ) :
+    # operands evaluated out of order are swapped back with ROT_TWO,
+    # so the operator sees them as written
+    if self.swaps( left, right ) :
+      self.emit( right )
+      self.emit( left )
+      self.b.emit_rot_two()
+    else :
+      self.emit( left )
+      self.emit( right )
+
+  def emit_BinOp( self, node ) :
+    self.emit_operands( node.left, node.right )
+    getattr( self.b, 'emit_' + _binary_ops[type(node.op)][0] )()
+
+  def emit_UnaryOp( self, node ) :
+    self.emit( node.operand )
+    getattr( self.b, 'emit_' + _unary_ops[type(node.op)][0] )()
+
+  def emit_Compare( self, node ) :
+    if len(node.ops) != 1 :
+      raise ValueError( 'chained comparisons are not supported in expressions' )
+    self.emit_operands( node.left, node.comparators[0] )
+    self.b.emit_compare_op( _compare_ops[type(node.ops[0])][0] )
+
+  def emit_BoolOp( self, node ) :
+    if isinstance(node.op,ast.And) :
+      jump = self.b.emit_jump_if_false_or_pop
+    else :
+      jump = self.b.emit_jump_if_true_or_pop
+    end = self.b.make_label( 'expr' )
+    for value in node.values[:-1] :
+      self.emit( value )
+      jump( end )
+    self.emit( node.values[-1] )
+    self.b.emit_label( end )
+
+  def emit_IfExp( self, node ) :
+    orelse = self.b.make_label( 'expr' )
+    end = self.b.make_label( 'expr' )
+    self.emit( node.test )
+    self.b.emit_pop_jump_if_false( orelse )
+    self.emit( node.body )
+    self.b.emit_jump_forward( end )
+    self.b.emit_label( orelse )
+    self.emit( node.orelse )
+    self.b.emit_label( end )
+
+  def emit_Attribute( self, node ) :
+    self.emit( node.value )
+    self.b.emit_load_attr( node.attr )
+
+  def emit_Subscript( self, node ) :
+    self.emit( node.value )
+    self.emit( _index(node) )
+    self.b.emit_binary_subscr()
+
+  def emit_Tuple( self, node ) :
+    for elt in node.elts :
+      self.emit( elt )
+    self.b.emit_build_tuple( len(node.elts) )
+
+  def emit_Call( self, node ) :
+    if node.keywords or any( isinstance(a,ast.Starred) for a in node.args ) :
+      raise ValueError( 'only positional arguments are supported in calls' )
+    self.emit( node.func )
+    for arg in node.args :
+      self.emit( arg )
+    self.b.emit_call_function( len(node.args) )
+
+
+def emit_expression( builder, expr, fold=True ) :
+
+  # Emits code pushing the value of an expression, given as source
+  # text or an `ast` expression. Supported are constants, names,
+  # arithmetic, comparisons, `and`/`or`, conditional expressions,
+  # tuples, attributes, subscripts and calls with positional arguments.
+  # Names are loaded as locals if they are parameters or locals of
+  # the builder, from cells if they are cell or closure variables,
+  # and as globals otherwise. Returns the number of stack slots the
+  # expression needs
+
+  if isinstance(expr,str) :
+    expr = ast.parse( expr, mode='eval' ).body
+  elif isinstance(expr,ast.Expression) :
+    expr = expr.body
+
+  if fold :
+    expr = fold_constants( expr )
+
+  emitter = _Emitter( builder )
+  emitter.emit( expr )
+  return emitter.need( expr )
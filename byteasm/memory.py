@@ -0,0 +1,105 @@
+from . assemble import *
+
+import collections
+import sys
+import types
+
+__all__ = [
+    'CodeMemory'
+  , 'memory_report'
+  , 'memory_summary'
+  ]
+
+##################################################
+#                                                #
+##################################################
+CodeMemory = collections.namedtuple( 
+    'CodeMemory'
+  , ( 'name'
+    , 'code_size'
+    , 'lnotab_size'
+    , 'consts_size'
+    , 'names'
+    , 'varnames'
+    , 'stacksize'
+    , 'total'
+    )
+  )
+
+##################################################
+#                                                #
+##################################################
+def _deep_size( value, seen ) :
+
+  # size of an object and everything reachable from it through
+  # the containers that can appear in a constant pool. Objects in
+  # `seen` have already been counted and contribute nothing
+
+  if id(value) in seen :
+    return 0
+  seen.add( id(value) )
+
+  size = sys.getsizeof( value )
+
+  if isinstance(value,(tuple,list,frozenset,set)) :
+    for item in value :
+      size += _deep_size( item, seen )
+
+  elif isinstance(value,dict) :
+    for k,v in value.items() :
+      size += _deep_size( k, seen )
+      size += _deep_size( v, seen )
+
+  elif isinstance(value,types.CodeType) :
+    for item in (value.co_code, value.co_lnotab, value.co_consts, value.co_names, value.co_varnames) :
+      size += _deep_size( item, seen )
+
+  return size
+
+
+def memory_report( fn, seen=None ) :
+
+  # Breaks down the memory held by the code object of `fn`. When
+  # reporting on several functions, passing the same `seen` set to
+  # each call avoids counting constants they share more than once
+
+  if seen is None :
+    seen = set()
+
+  co = fn.__code__
+
+  code_size   = _deep_size( co.co_code, seen )
+  lnotab_size = _deep_size( co.co_lnotab, seen )
+  consts_size = _deep_size( co.co_consts, seen )
+  total       = code_size + lnotab_size + consts_size  \
+              + _deep_size( co, seen )                 \
+              + _deep_size( co.co_names, seen )        \
+              + _deep_size( co.co_varnames, seen )
+
+  return CodeMemory(
+              co.co_name
+            , code_size
+            , lnotab_size
+            , consts_size
+            , len(co.co_names)
+            , len(co.co_varnames)
+            , co.co_stacksize
+            , total
+            )
+
+
+def memory_summary( fns=None ) :
+
+  # Reports on every live function produced by `assemble` (or on
+  # `fns`, if given), largest first, along with their combined 
+  # total. Objects shared between functions count towards the
+  # first function reported that holds them
+
+  if fns is None :
+    fns = assembled_functions()
+
+  seen    = set()
+  reports = [ memory_report( fn, seen ) for fn in fns ]
+  reports.sort( key=lambda r : r.total, reverse=True )
+
+  return sum( r.total for r in reports ), reports
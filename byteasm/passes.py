@@ -0,0 +1,593 @@
+from . analysis import *
+from . analysis import _handler_ops
+from . assemble import *
+from . constants import *
+from . stack import *
+from . utils import *
+
+import array
+import collections
+import opcode
+
+__all__ = [
+    'Profile'
+  , 'forward_stores'
+  , 'instrument_blocks'
+  , 'label_blocks'
+  , 'layout_blocks'
+  , 'profile_of'
+  , 'reuse_local_slots'
+  , 'rewrite_method_calls'
+  ]
+
+# Passes rewrite the instruction stream of a `FunctionBuilder`
+# before it is encoded. A pass is called as 
+#
+#   pass( ops, labels, signature ) -> ops, labels
+#
+# where `ops` is a list of `(line,op,typ,raw,fop)` entries and
+# `labels` maps label names to indices into `ops`. Passes must not
+# modify their inputs in place. Passes marked with `analysis_pass`
+# are also given the `Analysis` of their input, which they may 
+# use to look up (and share) the results of analyses
+
+##################################################
+#                                                #
+##################################################
+def _analysis_of( ops, labels, analysis ) :
+  if analysis is None :
+    analysis = Analysis( ops, labels )
+  return analysis
+
+
+##################################################
+#                                                #
+##################################################
+# instructions that push more than one value. Each is listed
+# with the number of values it consumes from (or otherwise
+# reads on) the stack. Those the running python does not have
+# are left out
+_multi_push_pops = {
+    opcode.opmap[name] : n for name, n in (
+        ('DUP_TOP'           , 1)
+      , ('DUP_TOP_TWO'       , 2)
+      , ('ROT_TWO'           , 2)
+      , ('ROT_THREE'         , 3)
+      , ('ROT_FOUR'          , 4)
+      , ('LOAD_METHOD'       , 1)
+      , ('UNPACK_SEQUENCE'   , 1)
+      , ('UNPACK_EX'         , 1)
+      , ('BEFORE_ASYNC_WITH' , 1)
+      , ('GET_ANEXT'         , 1)
+      ) if name in opcode.opmap
+  }
+
+@analysis_pass
+def rewrite_method_calls( ops, labels, signature, analysis=None ) :
+
+  # Turns `LOAD_ATTR name ... CALL_FUNCTION n` into 
+  # `LOAD_METHOD name ... CALL_METHOD n` when the attribute is 
+  # the callee of the call and nothing in between touches it. 
+  # Pairs are only matched within a single block, which means
+  # that the stack depth of each instruction relative to the
+  # start of the block is known. An attribute loaded at depth 
+  # `c` is the callee of `CALL_FUNCTION n` if the call is entered
+  # at depth `c+n` and no instruction in between reaches down to
+  # depth `c`
+
+  result = list(ops)
+
+  for start, blk in _analysis_of( ops, labels, analysis ).blocks.items() :
+
+    pending = []
+    before  = 0
+    for idx, _, op, raw, arg, _, after in blk.instructions :
+
+      if after is None :
+        break
+
+      if op == CALL_FUNCTION :
+        callee = before - arg
+        while pending and pending[-1][1] > callee :
+          pending.pop()
+        if pending and pending[-1][1] == callee :
+          attr, _ = pending.pop()
+          line, _, _, name, _ = result[attr]
+          result[attr] = (line, LOAD_METHOD, NameArg, name, fop(LOAD_METHOD))
+          line = result[idx][0]
+          result[idx] = (line, CALL_METHOD, GenericArg, arg, fop(CALL_METHOD))
+
+      pops = _multi_push_pops.get( op )
+      if pops is None :
+        reach = after
+      else :
+        reach = before - pops + 1
+      while pending and pending[-1][1] >= reach :
+        pending.pop()
+
+      if op == LOAD_ATTR :
+        pending.append( (idx,after) )
+
+      before = after
+
+  return result, labels
+
+
+##################################################
+#                                                #
+##################################################
+_name_ops    = frozenset(( LOAD_NAME, STORE_NAME, DELETE_NAME ))
+
+def _is_analyzable( ops ) :
+
+  # locals accessed by name, or `finally` blocks entered through
+  # CALL_FINALLY (whose return address is a value on the stack),
+  # defeat the simple liveness analysis of `Analysis`
+  for _, op, _, _, _ in ops :
+    if op in _name_ops or op == CALL_FINALLY :
+      return False
+  return True
+
+
+##################################################
+#                                                #
+##################################################
+@analysis_pass
+def reuse_local_slots( ops, labels, signature, analysis=None ) :
+
+  # Renames local variables whose live ranges do not overlap so
+  # that they share a single slot in the frame. Parameters, 
+  # locals that may be read before they are assigned, and locals
+  # that are live into an exception handler keep their own slots
+
+  if not _is_analyzable( ops ) :
+    return ops, labels
+
+  analysis = _analysis_of( ops, labels, analysis )
+  blocks = analysis.blocks
+  live_in, live_out, pinned = analysis.liveness
+
+  pinned = pinned | set( signature.parameters )
+  if 0 in live_in :
+    pinned |= live_in[ 0 ]
+
+  # two locals interfere if one is assigned while the other is live
+  interference = collections.defaultdict( set )
+  for ip, blk in blocks.items() :
+    live = set( live_out[ ip ] )
+    for idx, _, op, _, _, typ, _ in reversed(blk.instructions) :
+      if typ != LocalArg :
+        continue
+      name = ops[idx][3]
+      if op == LOAD_FAST :
+        live.add( name )
+      else :
+        for other in live :
+          if other != name :
+            interference[ name ].add( other )
+            interference[ other ].add( name )
+        if op == DELETE_FAST :
+          live.add( name )
+        else :
+          live.discard( name )
+
+  # greedily assign locals, in order of first appearance, to the
+  # first slot none of whose occupants it interferes with
+  slots  = []
+  rename = {}
+  for _, _, typ, raw, _ in ops :
+    if typ != LocalArg or raw in rename or raw in pinned :
+      continue
+    for members in slots :
+      if not (members & interference[raw]) :
+        break
+    else :
+      members = set()
+      slots.append( members )
+    if members :
+      rename[ raw ] = rename[ next(iter(members)) ]
+    else :
+      rename[ raw ] = raw
+    members.add( raw )
+
+  result = []
+  for line, op, typ, raw, fop in ops :
+    if typ == LocalArg :
+      raw = rename.get( raw, raw )
+    result.append( (line,op,typ,raw,fop) )
+
+  return result, labels
+
+
+##################################################
+#                                                #
+##################################################
+def _remove_ops( ops, labels, removed ) :
+
+  # drops the instructions at the given indices. Labels on a 
+  # removed instruction move to the one that follows it
+  result = []
+  index  = []
+  for idx, entry in enumerate(ops) :
+    index.append( len(result) )
+    if idx not in removed :
+      result.append( entry )
+  index.append( len(result) )
+
+  return result, { k : index[v] for k,v in labels.items() }
+
+
+@analysis_pass
+def forward_stores( ops, labels, signature, analysis=None ) :
+
+  # Removes stores of locals that are never read back. Given
+  # `STORE_FAST x; LOAD_FAST x` in which the load is not a jump 
+  # target, the pair is dropped entirely if `x` is not used again 
+  # and becomes `DUP_TOP; STORE_FAST x` otherwise. Any other store
+  # whose value is dead becomes a POP_TOP
+
+  if not _is_analyzable( ops ) :
+    return ops, labels
+
+  analysis = _analysis_of( ops, labels, analysis )
+  blocks = analysis.blocks
+  live_in, live_out, pinned = analysis.liveness
+
+  targets = set( labels.values() )
+  result  = list(ops)
+  removed = set()
+
+  for ip, blk in blocks.items() :
+
+    # locals live immediately after each instruction of the block
+    live  = set( live_out[ ip ] )
+    after = {}
+    for idx, _, op, _, _, typ, _ in reversed(blk.instructions) :
+      after[ idx ] = set( live )
+      if typ == LocalArg :
+        name = ops[idx][3]
+        if op == LOAD_FAST or op == DELETE_FAST :
+          live.add( name )
+        else :
+          live.discard( name )
+
+    for idx, _, op, _, _, _, _ in blk.instructions :
+
+      if op != STORE_FAST or idx in removed :
+        continue
+
+      line, _, _, name, _ = ops[idx]
+      if name in pinned :
+        continue
+
+      nxt = idx + 1
+      if nxt in after and nxt not in targets \
+          and ops[nxt][1] == LOAD_FAST and ops[nxt][3] == name :
+        if name in after[ nxt ] :
+          result[ idx ] = (line, DUP_TOP, NilArg, None, None)
+          result[ nxt ] = ops[ idx ]
+        else :
+          removed.update( (idx,nxt) )
+
+      elif name not in after[ idx ] :
+        result[ idx ] = (line, POP_TOP, NilArg, None, None)
+
+  result, labels = _remove_ops( result, labels, removed )
+
+  # the rewrite is only sound if the stack remains balanced, which
+  # the stack depth analysis checks for us
+  analysis.update( result, labels ).stack_depth
+
+  return result, labels
+
+
+##################################################
+#                                                #
+##################################################
+_unconditional_jumps = frozenset(( JUMP_ABSOLUTE, JUMP_FORWARD ))
+_no_fall_through     = frozenset(( JUMP_ABSOLUTE, JUMP_FORWARD, RETURN_VALUE, RAISE_VARARGS ))
+_inverted_jumps      = { 
+    POP_JUMP_IF_FALSE : POP_JUMP_IF_TRUE
+  , POP_JUMP_IF_TRUE  : POP_JUMP_IF_FALSE
+  }
+
+def _block_edges( ops, blocks ) :
+
+  # for every block, returns the block it falls through to and the
+  # block it may jump to (either of which may be None)
+  edges = {}
+  for ip, blk in blocks.items() :
+    idx, _, op, raw, _, typ, _ = blk.instructions[-1]
+    fall = None
+    if op not in _no_fall_through and idx+1 < len(ops) :
+      fall = idx+1
+    jump = None
+    if typ == AbsLabelArg or typ == RelLabelArg :
+      jump = raw
+    edges[ ip ] = fall, jump
+  return edges
+
+
+@analysis_pass
+def layout_blocks( ops, labels, signature, weights=None, analysis=None ) :
+
+  # Reorders blocks so that the likely successor of each block 
+  # follows it directly. `weights` optionally maps label names to
+  # the relative frequency with which the labeled block is entered
+  # (for instance, from a profile). Without weights, the layout 
+  # keeps blocks in the same loop together, prefers the existing
+  # fall through, and moves blocks that can only end in a raise, 
+  # along with exception handlers, to the end of the function. 
+  # Conditional jumps are inverted where that lets the preferred 
+  # successor fall through, and unconditional jumps are added or 
+  # removed as needed. Targets of relative jumps, which can only 
+  # jump forwards, are always placed after their sources
+
+  analysis = _analysis_of( ops, labels, analysis )
+  blocks = analysis.blocks
+  if not blocks :
+    return ops, labels
+
+  edges = _block_edges( ops, blocks )
+  order = list( blocks )
+  last  = blocks[ order[-1] ].instructions[-1]
+  if last[2] not in _no_fall_through :
+    # code that runs off the end must stay where it is
+    return ops, labels
+
+  # labels naming each block
+  names = collections.defaultdict( list )
+  for k,v in labels.items() :
+    names[ v ].append( k )
+
+  weight = {}
+  if weights :
+    for ip in blocks :
+      known = [ weights[k] for k in names[ip] if k in weights ]
+      if known :
+        weight[ ip ] = max( known )
+
+  # cold blocks: handlers, and blocks that can only lead to a raise
+  cold = set()
+  rel_sources = collections.defaultdict( set )
+  for ip, blk in blocks.items() :
+    idx, _, op, raw, _, typ, _ = blk.instructions[-1]
+    if op in _handler_ops :
+      cold.add( raw )
+    if op == RAISE_VARARGS :
+      cold.add( ip )
+    if typ == RelLabelArg and op not in _unconditional_jumps :
+      rel_sources[ raw ].add( ip )
+
+  changed = True
+  while changed :
+    changed = False
+    for ip, (fall, jump) in edges.items() :
+      succ = [ t for t in (fall,jump) if t is not None ]
+      if ip not in cold and ip != order[0] and succ and all( t in cold for t in succ ) :
+        cold.add( ip )
+        changed = True
+
+  if weights :
+    cold |= { ip for ip,w in weight.items() if not w }
+
+  depth = analysis.loop_depths
+
+  # greedily chain blocks together
+  placed = []
+  done   = set()
+
+  def eligible( ip ) :
+    return ip not in done and rel_sources[ ip ] <= done
+
+  cur = order[0]
+  while cur is not None :
+
+    placed.append( cur )
+    done.add( cur )
+
+    fall, jump = edges[ cur ]
+    best = None
+    for ip, is_fall in ((fall,True),(jump,False)) :
+      if ip is None or not eligible(ip) :
+        continue
+      if ip in cold and cur not in cold :
+        continue
+      score = (weight.get(ip,0), depth[ip], is_fall)
+      if best is None or score > best[0] :
+        best = score, ip
+
+    if best is not None :
+      cur = best[1]
+    else :
+      cur = next( (ip for ip in order if eligible(ip) and ip not in cold), None )
+      if cur is None :
+        cur = next( (ip for ip in order if eligible(ip)), None )
+
+  # emit blocks in their new order, fixing up control flow
+  def label_of( ip ) :
+    if not names[ ip ] :
+      name = f'layout_{ip}'
+      while name in labels :
+        name += '_'
+      names[ ip ].append( name )
+    return names[ ip ][0]
+
+  position = { ip : i for i,ip in enumerate(placed) }
+  result   = []
+  starts   = {}
+
+  for i, ip in enumerate(placed) :
+
+    starts[ ip ] = len(result)
+    following = placed[i+1] if i+1 < len(placed) else None
+
+    instructions = blocks[ ip ].instructions
+    for entry in instructions[:-1] :
+      result.append( ops[entry[0]] )
+
+    idx = instructions[-1][0]
+    line, op, typ, raw, fop = ops[ idx ]
+    fall, jump = edges[ ip ]
+
+    if op in _unconditional_jumps :
+      if jump != following :
+        op = JUMP_FORWARD if position[jump] > i else JUMP_ABSOLUTE
+        result.append( (line,op,_jump_type(op),raw,None) )
+      continue
+
+    if op in _inverted_jumps and fall != following and jump == following :
+      op = _inverted_jumps[ op ]
+      result.append( (line,op,typ,label_of(fall),fop) )
+      continue
+
+    result.append( (line,op,typ,raw,fop) )
+    if fall is not None and fall != following :
+      op = JUMP_FORWARD if position[fall] > i else JUMP_ABSOLUTE
+      result.append( (line,op,_jump_type(op),label_of(fall),None) )
+
+  starts[ len(ops) ] = len(result)
+
+  new_labels = {}
+  for ip, ks in names.items() :
+    for k in ks :
+      new_labels[ k ] = starts[ ip ]
+
+  return result, new_labels
+
+
+def _jump_type( op ) :
+  return RelLabelArg if op in opcode.hasjrel else AbsLabelArg
+
+
+##################################################
+#                                                #
+##################################################
+@analysis_pass
+def label_blocks( ops, labels, signature, analysis=None ) :
+
+  # Gives every block a label. Names are derived from the order of
+  # blocks alone, so the same instruction stream always produces
+  # the same names. This lets information gathered about blocks
+  # of one build (such as a profile) be applied to another
+  blocks = _analysis_of( ops, labels, analysis ).blocks.items()
+  named  = set( labels.values() )
+
+  labels = dict(labels)
+  for n, (ip,_) in enumerate(blocks) :
+    if ip not in named :
+      name = f'block_{n}'
+      while name in labels :
+        name += '_'
+      labels[ name ] = ip
+
+  return ops, labels
+
+
+class Profile( array.array ) :
+
+  # Counters filled in by a function made with `instrument=True`.
+  # Each counter belongs to a site, which is either the entry to a
+  # labeled block, or the fall-through path out of a labeled block
+  # ending in a conditional branch
+
+  def __new__( cls ) :
+    return super().__new__( cls, 'Q' )
+
+  def __init__( self ) :
+    self.sites = []
+
+  def add_site( self, kind, label ) :
+    self.sites.append( (kind,label) )
+    self.append( 0 )
+    return len(self) - 1
+
+  def block_counts( self ) :
+    return { label : self[i] for i,(kind,label) in enumerate(self.sites) if kind == 'block' }
+
+  def branch_counts( self ) :
+
+    # maps each branching block to the number of times its branch
+    # was taken and not taken
+    entered = self.block_counts()
+
+    result = {}
+    for i, (kind,label) in enumerate(self.sites) :
+      if kind == 'fall' :
+        result[ label ] = (entered[label]-self[i], self[i])
+    return result
+
+  def weights( self ) :
+    return self.block_counts()
+
+
+def profile_of( fn ) :
+  # the profile of an instrumented function is one of its constants
+  for value in fn.__code__.co_consts :
+    if isinstance(value,Profile) :
+      return value
+
+
+_branches = frozenset(( 
+    POP_JUMP_IF_FALSE 
+  , POP_JUMP_IF_TRUE
+  , JUMP_IF_FALSE_OR_POP
+  , JUMP_IF_TRUE_OR_POP
+  , FOR_ITER 
+  ))
+
+@analysis_pass
+def instrument_blocks( ops, labels, signature, profile, analysis=None ) :
+
+  # Adds code counting entries to every labeled block, and the 
+  # number of times each conditional branch falls through, into
+  # `profile`. Each counter update leaves the stack as it was found:
+  #
+  #     LOAD_CONST    profile
+  #     LOAD_CONST    index
+  #     DUP_TOP_TWO
+  #     BINARY_SUBSCR
+  #     LOAD_CONST    1
+  #     INPLACE_ADD
+  #     ROT_THREE
+  #     STORE_SUBSCR
+
+  def count( line, site ) :
+    return [
+        (line, LOAD_CONST    , ConstantArg , profile , None)
+      , (line, LOAD_CONST    , ConstantArg , site    , None)
+      , (line, DUP_TOP_TWO   , NilArg      , None    , None)
+      , (line, BINARY_SUBSCR , NilArg      , None    , None)
+      , (line, LOAD_CONST    , ConstantArg , 1       , None)
+      , (line, INPLACE_ADD   , NilArg      , None    , None)
+      , (line, ROT_THREE     , NilArg      , None    , None)
+      , (line, STORE_SUBSCR  , NilArg      , None    , None)
+      ]
+
+  names = {}
+  for k,v in sorted( labels.items() ) :
+    names.setdefault( v, k )
+
+  blocks = _analysis_of( ops, labels, analysis ).blocks.items()
+  entry  = {}
+  fall   = {}
+  for ip, blk in blocks :
+    if ip in names :
+      entry[ ip ] = profile.add_site( 'block', names[ip] )
+      idx, _, op, _, _, _, _ = blk.instructions[-1]
+      if op in _branches :
+        fall[ idx+1 ] = profile.add_site( 'fall', names[ip] )
+
+  result   = []
+  position = []
+  for idx, item in enumerate(ops) :
+    line = item[0]
+    if idx in fall :
+      result.extend( count( line, fall[idx] ) )
+    position.append( len(result) )
+    if idx in entry :
+      result.extend( count( line, entry[idx] ) )
+    result.append( item )
+  position.append( len(result) )
+
+  return result, { k : position[v] for k,v in labels.items() }
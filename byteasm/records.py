@@ -0,0 +1,147 @@
+from . builder import *
+
+import collections
+import struct
+
+__all__ = [
+    'Field'
+  , 'make_record_decoder'
+  ]
+
+##################################################
+#                                                #
+##################################################
+# A field of a fixed-layout record, at `offset` bytes from the start
+# of the record. Its value is a single item of the `struct` format
+# `format`, or a tuple of `count` of them. With `strings`, a pair
+# `(offset,size)` locating a table of NUL-terminated strings, the
+# items are offsets into that table, and the value is the strings
+# found there (None for offsets outside of the table, such as -1).
+# The size may be given as the name of an earlier scalar field.
+# `format` must describe a single item, such as 'h' or '8s'
+Field = collections.namedtuple( 'Field', 'name offset format count strings' )
+Field.__new__.__defaults__ = (None,None)
+
+
+def _c_string( table, start, encoding ) :
+  if not 0 <= start < len(table) :
+    return None
+  end = table.find( b'\0', start )
+  if end < 0 :
+    end = len(table)
+  value = table[start:end]
+  if encoding is not None :
+    value = value.decode( encoding )
+  return value
+
+
+##################################################
+#                                                #
+##################################################
+def make_record_decoder( name, fields, *, byteorder='<', encoding=None, fglobals=None ) :
+
+  # Generates a function `name(buffer, offset=0)` decoding a record
+  # at `offset` into a namedtuple with a member for each field. All
+  # of the numeric fields are read by a single precompiled `struct`
+  # whose layout pads over any gaps between them, reading straight
+  # from the buffer, which may be a `memoryview`. What follows is
+  # straight-line code that picks out each field, so nothing about
+  # the layout is looked at when a record is decoded. Strings are
+  # copied out of their table, which is itself copied once
+
+  if byteorder not in ('<','>','!','=') :
+    raise ValueError( f'byteorder must specify standard sizes, not {byteorder!r}' )
+
+  fields = [ Field(*f) for f in fields ]
+
+  # lay out one struct covering every field, in order of offset
+  fmt   = byteorder
+  pos   = None
+  start = None
+  items = 0
+  slots = {}
+  for f in sorted( fields, key=lambda f : f.offset ) :
+    if pos is None :
+      start = pos = f.offset
+    if f.offset < pos :
+      raise ValueError( f'field {f.name!r} overlaps the field before it' )
+    item = struct.Struct( byteorder+f.format )
+    if len( item.unpack( bytes(item.size) ) ) != 1 :
+      raise ValueError( f'format {f.format!r} of field {f.name!r} is not a single item' )
+    n = 1 if f.count is None else f.count
+    code = f.format * n
+    fmt += 'x' * (f.offset - pos) + code
+    pos = f.offset + struct.calcsize( byteorder+code )
+    slots[ f.name ] = (items, n)
+    items += n
+
+  result = collections.namedtuple( name, [ f.name for f in fields ] )
+  layout = struct.Struct( fmt )
+
+  b = FunctionBuilder()
+  b.add_positional_arg( 'buffer' )
+  b.add_positional_arg( 'offset', default=0 )
+
+  def emit_offset( delta ) :
+    b.emit_load_fast( 'offset' )
+    if delta :
+      b.emit_load_const( delta )
+      b.emit_binary_add()
+
+  def emit_item( i ) :
+    b.emit_load_fast( 'values' )
+    b.emit_load_const( i )
+    b.emit_binary_subscr()
+
+  if fields :
+    b.emit_load_const( layout.unpack_from )
+    b.emit_load_fast( 'buffer' )
+    emit_offset( start )
+    b.emit_call_function( 2 )
+    b.emit_store_fast( 'values' )
+
+  # copy out each string table
+  tables = {}
+  for f in fields :
+    if f.strings is None or f.strings in tables :
+      continue
+    local = f'table_{len(tables)}'
+    tables[ f.strings ] = local
+    table_offset, size = f.strings
+    b.emit_load_const( bytes )
+    b.emit_load_fast( 'buffer' )
+    emit_offset( table_offset )
+    b.emit_dup_top()
+    if isinstance(size,str) :
+      emit_item( slots[size][0] )
+    else :
+      b.emit_load_const( size )
+    b.emit_binary_add()
+    b.emit_build_slice( 2 )
+    b.emit_binary_subscr()
+    b.emit_call_function( 1 )
+    b.emit_store_fast( local )
+
+  b.emit_load_const( result )
+  for f in fields :
+    first, n = slots[ f.name ]
+    if f.strings is not None :
+      for i in range( first, first+n ) :
+        b.emit_load_const( _c_string )
+        b.emit_load_fast( tables[ f.strings ] )
+        emit_item( i )
+        b.emit_load_const( encoding )
+        b.emit_call_function( 3 )
+      if f.count is None :
+        continue
+      b.emit_build_tuple( n )
+    elif f.count is None :
+      emit_item( first )
+    else :
+      b.emit_load_fast( 'values' )
+      b.emit_load_const( slice( first, first+n ) )
+      b.emit_binary_subscr()
+  b.emit_call_function( len(fields) )
+  b.emit_return_value()
+
+  return b.make( name, fglobals or {} )
@@ -8,11 +8,20 @@ import opcode
 
 __all__ = [
     'StackEffects'
+  , 'annotated_stack_depth'
   , 'compute_stack_depth'
   , 'make_annotated_cfg'
   ]
 
 
+# the number of distinct states a block may reach before they are
+# merged (see `_widen`). This is when widening starts, not a limit
+# on the states kept: a widened block keeps one state for each
+# set of frames and exception flag it is reached with, as far as
+# their flags go
+MaxBlockStates = 64
+
+
 ##################################################
 #                                                #
 ##################################################
@@ -99,14 +108,29 @@ def _make_effects_tab() :
   def AdjustValueStack( delta ) :
     return (lambda s,b,e : s+delta)
 
+  # A frame holds the depth of the value stack it unwinds to, and
+  # the exception flag of the code around it, which is restored when
+  # the frame is popped. A finally block can hold whole try statements
+  # of its own, and the flag of the finally block, which decides what
+  # its `END_FINALLY` does, must survive them. Entering a finally
+  # block normally (`BEGIN_FINALLY`) or as a subroutine
+  # (`CALL_FINALLY`) pushes a frame for the same reason
+
   def PopFrameStack( s, b, e ) :
     return tail_expr(b)
 
   def PeekFrameStack( s, b, e ) :
-    return head_expr(b)
+    return head_expr(b)[0]
+
+  def RestoreFlag( s, b, e ) :
+    return head_expr(b)[1]
 
   def PushFrameStack( s, b, e ) :
-    return cons_expr(s,b)
+    return cons_expr((s,e),b)
+
+  # SETUP_ASYNC_WITH installs its block beneath the value on top
+  def PushUnderTop( s, b, e ) :
+    return cons_expr((s-1,e),b)
 
   def Next( se=None, fe=None, ee=None, ne=None ) :
     return first, se, fe, ee, ne
@@ -157,16 +181,21 @@ def _make_effects_tab() :
     , ( opcode.hasjabs        , 1 , Next(), Arg()                                                         )
     , ( RAISE_VARARGS         , 1 , Other( IP_EXCEPT )                                                    )
     , ( RETURN_VALUE          , 1 , Other( IP_END )                                                       )
-    , ( END_FINALLY           , 3 , Next( se=(lambda s,b,e:select_expr(e,s-6,s-1)), ee=False, ne=third )  )
+    , ( BEGIN_FINALLY         , 3 , Next( se=1, fe=PushFrameStack, ee=False )                             )
+    , ( CALL_FINALLY          , 3 , Next(), Arg( se=1, fe=PushFrameStack, ee=True )                       )
+    , ( END_FINALLY           , 3 , Next( se=(lambda s,b,e:select_expr(e,s-6,s-1)), fe=PopFrameStack, ee=RestoreFlag, ne=third ) )
+    , ( POP_FINALLY           , 3 , Next( se=-1, fe=PopFrameStack, ee=RestoreFlag )                       )
     , ( FOR_ITER              , 3 , Next( se=1 ), Arg( se=-1 )                                            )
     , ( JUMP_ABSOLUTE         , 3 , Arg()                                                                 )
     , ( JUMP_FORWARD          , 3 , Arg()                                                                 )
     , ( JUMP_IF_FALSE_OR_POP  , 3 , Next( se=-1 ), Arg()                                                  )
     , ( JUMP_IF_TRUE_OR_POP   , 3 , Next( se=-1 ), Arg()                                                  )
-    , ( POP_BLOCK             , 3 , Next( se=PeekFrameStack, fe=PopFrameStack )                           )
-    , ( POP_EXCEPT            , 3 , Next( se=PeekFrameStack, fe=PopFrameStack, ee=False )                 )
-    , ( SETUP_FINALLY         , 3 , Next( fe=PushFrameStack, ee=False ), Arg( se=6, ee=True )             )
+    , ( POP_BLOCK             , 3 , Next( fe=PopFrameStack, ee=RestoreFlag )                              )
+    , ( POP_EXCEPT            , 3 , Next( se=PeekFrameStack, fe=PopFrameStack, ee=RestoreFlag )           )
+    , ( SETUP_FINALLY         , 3 , Next( fe=PushFrameStack, ee=False ), Arg( se=6, fe=PushFrameStack, ee=True ) )
     , ( SETUP_WITH            , 3 , Next( se=1, fe=PushFrameStack ), Arg( se=7, ee=True )                 )
+    , ( SETUP_ASYNC_WITH      , 3 , Next( fe=PushUnderTop ), Arg( se=5, fe=PushUnderTop, ee=True )     )
+    , ( END_ASYNC_FOR         , 3 , Next( se=(lambda s,b,e:head_expr(b)[0]-1), fe=PopFrameStack, ee=RestoreFlag ) )
     )
 
 
@@ -231,6 +260,7 @@ def _make_extended_blocks( se, merge=True ) :
       ext.sources             = block_sources
       ext.dependents          = set( blk.targets.keys() )
       ext.values              = set()
+      ext.widened             = False
 
       blocks[ip] = ext
 
@@ -241,7 +271,30 @@ def _make_extended_blocks( se, merge=True ) :
 ##################################################
 #                                                #
 ##################################################
-def _compute_stack_usage( blocks, n=1000 ) :
+def _widen( states ) :
+
+  # Merges states that differ only in stack depths, both that of the
+  # value stack and those saved on the frame stack, into one holding
+  # the greatest of each. Every effect is monotone in the depths it
+  # reads, so the depths computed from a merged state bound those of
+  # the states it replaces. The exception flags, current and saved
+  # in each frame, decide which edges are followed and how many frames
+  # are popped, and are kept exact. So one state remains for each
+  # sequence of them, however many that is
+
+  merged = {}
+  for s,f,e in states :
+    key = (tuple( flag for _,flag in f ), e)
+    if key in merged :
+      ms, mf = merged[ key ]
+      s = max( s, ms )
+      f = cons_expr( *map(max,f,mf), empty_frames )
+    merged[ key ] = (s, f)
+
+  return { (s,f,e) for (_,e),(s,f) in merged.items() }
+
+
+def _compute_stack_usage( blocks, n=1000, max_states=None ) :
 
   # Computes usage of the cpython value stack by abstract interpretation.
   # To compute this information, it is necessary to also calculate
@@ -250,10 +303,23 @@ def _compute_stack_usage( blocks, n=1000 ) :
   # generates some usages of END_FINALLY that depend on the fact
   # that an exception will always be reraised). Calculation proceeds 
   # by simple propagation of know values, iterating until steady state.
+  #
+  # A block reaching more than `max_states` states is widened: from
+  # then on its states are merged by `_widen` together with those it
+  # had before, leaving at most one state per exception flag and
+  # flags saved in its frames (which may still be more than
+  # `max_states`), at
+  # the cost of a stack depth that is an upper bound rather than
+  # exact. Returns the widened blocks, which are also marked by
+  # their `widened` flag
 
-  blocks[IP_START].values = {(0,(),False)}
+  if max_states is None :
+    max_states = MaxBlockStates
+
+  blocks[IP_START].values = {(0,empty_frames,False)}
 
   pending = {0}
+  widened = set()
 
   for _ in range(n) :
 
@@ -290,6 +356,13 @@ def _compute_stack_usage( blocks, n=1000 ) :
       for s,f,e in values :
         current.add((s+blk.delta,f,e))
 
+    if not blk.widened and len(current) > max_states :
+      blk.widened = True
+      widened.add( ip )
+
+    if blk.widened :
+      current = _widen( current | blk.values )
+
     if current != blk.values :
         blk.values = current
         pending.update( blk.dependents )
@@ -297,15 +370,17 @@ def _compute_stack_usage( blocks, n=1000 ) :
   if pending :
     raise Exception( 'convergence failure' )
 
+  return widened
+
 
 ##################################################
 #                                                #
 ##################################################
-def make_annotated_cfg( se, compute=True ) :
+def make_annotated_cfg( se, compute=True, **kwargs ) :
 
   blocks = _make_extended_blocks( se )
   if compute :
-    _compute_stack_usage( blocks )
+    _compute_stack_usage( blocks, **kwargs )
   return blocks
 
 
@@ -313,6 +388,10 @@ def compute_stack_depth( se, **kwargs ) :
 
   blocks = _make_extended_blocks( se )
   _compute_stack_usage( blocks, **kwargs )
+  return annotated_stack_depth( blocks )
+
+
+def annotated_stack_depth( blocks ) :
 
   max_stack = 0
   for blk in blocks.values() :
@@ -321,7 +400,3 @@ def compute_stack_depth( se, **kwargs ) :
       max_stack = max( max_stack, s-blk.delta+blk.max_delta )
 
   return max_stack
-
-
-
-
@@ -0,0 +1,201 @@
+from . constants import *
+
+import dis
+import opcode
+
+__all__ = [
+    'VerifyError'
+  , 'verify_code'
+  ]
+
+##################################################
+#                                                #
+##################################################
+class VerifyError( ValueError ) :
+
+  # Raised for malformed bytecode. When the code was generated by
+  # a `FunctionBuilder`, `index` and `line` identify the builder
+  # instruction responsible; otherwise they are None. An instruction
+  # added by a pass has a line but no index
+
+  def __init__( self, message, offset=None, index=None, line=None ) :
+    where = []
+    if index is not None :
+      where.append( f'instruction {index}' )
+    if line is not None :
+      where.append( f'line {line}' )
+    if offset is not None :
+      where.append( f'offset {offset}' )
+    if where :
+      message = f'{message} ({", ".join(where)})'
+    super().__init__( message )
+    self.offset = offset
+    self.index  = index
+    self.line   = line
+
+
+##################################################
+#                                                #
+##################################################
+_no_fall_through = frozenset(( JUMP_ABSOLUTE, JUMP_FORWARD, RETURN_VALUE, RAISE_VARARGS ))
+
+# not present before python 3.8
+_call_finally = opcode.opmap.get( 'CALL_FINALLY' )
+
+# the number of values each instruction pushes, for those where
+# that is fixed. Together with the net stack effect, this gives the
+# number of values it needs on the stack. Instructions that are
+# not listed (those that manage blocks and exception state) are
+# only checked for leaving the stack below empty. Instructions that
+# the running python does not have are skipped
+def _make_pushes_tab() :
+
+  pushes = {}
+  for names, n in (
+      ( (
+          'BINARY_ADD', 'BINARY_AND', 'BINARY_FLOOR_DIVIDE', 'BINARY_LSHIFT'
+        , 'BINARY_MATRIX_MULTIPLY', 'BINARY_MODULO', 'BINARY_MULTIPLY'
+        , 'BINARY_OR', 'BINARY_POWER', 'BINARY_RSHIFT', 'BINARY_SUBSCR'
+        , 'BINARY_SUBTRACT', 'BINARY_TRUE_DIVIDE', 'BINARY_XOR'
+        , 'INPLACE_ADD', 'INPLACE_AND', 'INPLACE_FLOOR_DIVIDE', 'INPLACE_LSHIFT'
+        , 'INPLACE_MATRIX_MULTIPLY', 'INPLACE_MODULO', 'INPLACE_MULTIPLY'
+        , 'INPLACE_OR', 'INPLACE_POWER', 'INPLACE_RSHIFT', 'INPLACE_SUBTRACT'
+        , 'INPLACE_TRUE_DIVIDE', 'INPLACE_XOR'
+        , 'UNARY_INVERT', 'UNARY_NEGATIVE', 'UNARY_NOT', 'UNARY_POSITIVE'
+        , 'LOAD_ATTR', 'LOAD_BUILD_CLASS', 'LOAD_CLASSDEREF', 'LOAD_CLOSURE'
+        , 'LOAD_CONST', 'LOAD_DEREF', 'LOAD_FAST', 'LOAD_GLOBAL', 'LOAD_NAME'
+        , 'BUILD_CONST_KEY_MAP', 'BUILD_LIST', 'BUILD_LIST_UNPACK', 'BUILD_MAP'
+        , 'BUILD_MAP_UNPACK', 'BUILD_MAP_UNPACK_WITH_CALL', 'BUILD_SET'
+        , 'BUILD_SET_UNPACK', 'BUILD_SLICE', 'BUILD_STRING', 'BUILD_TUPLE'
+        , 'BUILD_TUPLE_UNPACK', 'BUILD_TUPLE_UNPACK_WITH_CALL'
+        , 'CALL_FUNCTION', 'CALL_FUNCTION_EX', 'CALL_FUNCTION_KW', 'CALL_METHOD'
+        , 'COMPARE_OP', 'GET_ITER', 'GET_YIELD_FROM_ITER', 'GET_AWAITABLE'
+        , 'GET_AITER', 'FORMAT_VALUE', 'MAKE_FUNCTION', 'IMPORT_NAME'
+        , 'YIELD_VALUE', 'YIELD_FROM'
+        ), 1 )
+    , ( (
+          'POP_TOP', 'STORE_FAST', 'STORE_NAME', 'STORE_GLOBAL', 'STORE_DEREF'
+        , 'STORE_ATTR', 'STORE_SUBSCR', 'DELETE_SUBSCR', 'DELETE_ATTR'
+        , 'POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE', 'RETURN_VALUE', 'PRINT_EXPR'
+        , 'LIST_APPEND', 'SET_ADD', 'MAP_ADD', 'IMPORT_STAR', 'RAISE_VARARGS'
+        ), 0 )
+    , ( ( 'DUP_TOP', 'ROT_TWO', 'LOAD_METHOD', 'IMPORT_FROM', 'GET_ANEXT', 'BEFORE_ASYNC_WITH', 'FOR_ITER' ), 2 )
+    , ( ( 'ROT_THREE', ), 3 )
+    , ( ( 'DUP_TOP_TWO', 'ROT_FOUR' ), 4 )
+    ) :
+    for name in names :
+      op = opcode.opmap.get( name )
+      if op is not None :
+        pushes[ op ] = n
+
+  return pushes
+
+_pushes = _make_pushes_tab()
+
+
+def _stack_effect( op, arg, jump ) :
+  if op < opcode.HAVE_ARGUMENT :
+    return dis.stack_effect( op )
+  return dis.stack_effect( op, arg, jump=jump )
+
+
+def _needs( op, arg ) :
+  # the number of values an instruction reads from the stack
+  if op == UNPACK_SEQUENCE or op == UNPACK_EX :
+    return 1
+  pushes = _pushes.get( op )
+  if pushes is None :
+    return 0
+  return pushes - _stack_effect( op, arg, False )
+
+
+##################################################
+#                                                #
+##################################################
+def verify_code( code, origins=None ) :
+
+  # Checks bytecode (a code object, or its `co_code`) for stack
+  # underflow, jumps to anywhere but the start of an instruction
+  # and execution running off the end of the code. Instructions are
+  # decoded once, and then visited along the control flow graph,
+  # tracking the least stack depth at each. Visits are only repeated
+  # when a lower depth is found, which well formed code never leads
+  # to, so verification takes a single linear sweep in practice.
+  # Returns the greatest stack depth seen.
+  #
+  # `origins` optionally maps the offset of each instruction to the
+  # `(index,line)` of the builder instruction it was encoded from,
+  # for use in error messages
+
+  if isinstance(code,bytes) or isinstance(code,bytearray) :
+    raw = code
+  else :
+    raw = code.co_code
+
+  def error( message, offset ) :
+    index = line = None
+    if origins is not None and offset in origins :
+      index, line = origins[ offset ]
+    raise VerifyError( message, offset, index, line )
+
+  # decode. EXTENDED_ARG prefixes are part of the instruction that
+  # follows them
+  instructions = {}
+  start = None
+  ext   = 0
+  for i in range( 0, len(raw), 2 ) :
+    op, arg = raw[i], raw[i+1] | ext
+    if start is None :
+      start = i
+    if op == EXTENDED_ARG :
+      ext = arg << 8
+      continue
+    instructions[ start ] = (op, arg, i+2)
+    start = None
+    ext   = 0
+
+  if start is not None :
+    error( 'code ends with EXTENDED_ARG', start )
+  if 0 not in instructions :
+    error( 'code is empty', 0 )
+
+  depth   = { 0 : 0 }
+  pending = [ 0 ]
+  highest = 0
+
+  def push( source, target, d ) :
+    if target not in instructions :
+      error( f'jump to offset {target}, which does not start an instruction', source )
+    if target not in depth or d < depth[target] :
+      depth[ target ] = d
+      pending.append( target )
+
+  while pending :
+
+    offset = pending.pop()
+    op, arg, nxt = instructions[ offset ]
+    d = depth[ offset ]
+
+    if d < _needs( op, arg ) :
+      error( f'stack underflow in {opcode.opname[op]}', offset )
+
+    if op in opcode.hasjrel or op in opcode.hasjabs :
+      # the target of CALL_FINALLY is also reached by other paths,
+      # which it pushes fewer values than
+      if op != _call_finally :
+        after = d + _stack_effect( op, arg, True )
+        if after < 0 :
+          error( f'stack underflow in {opcode.opname[op]}', offset )
+        highest = max( highest, after )
+        push( offset, nxt + arg if op in opcode.hasjrel else arg, after )
+
+    if op not in _no_fall_through :
+      after = d + _stack_effect( op, arg, False )
+      if after < 0 :
+        error( f'stack underflow in {opcode.opname[op]}', offset )
+      if nxt >= len(raw) :
+        error( 'execution runs off the end of the code', offset )
+      highest = max( highest, after )
+      push( offset, nxt, after )
+
+  return highest
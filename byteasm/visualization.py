@@ -1,15 +1,17 @@
-from . import assemble
 from . aexpr import *
 from . constants import *
 from . stack import *
 from . visutil import *
 
+import collections
+import importlib
+import itertools
 import opcode
-import pygraphviz
 import types
 
 __all__ = [
-    'visualize'
+    'cfg_to_dot'
+  , 'visualize'
   ]
 
 ##################################################
@@ -29,13 +31,49 @@ def effect_expr_str( effect ) :
 ##################################################
 #                                                #
 ##################################################
-def visualize( se, output, indicate_dead=True ) :
-
-  G = pygraphviz.AGraph( directed=True )
-
-  blocks = make_annotated_cfg( se )
-
-  for ip,blk in sorted(blocks.items()) :
+def visualize( se, output, indicate_dead=True, **kwargs ) :
+  render_dot( cfg_to_dot( make_annotated_cfg( se ), indicate_dead, **kwargs ), output )
+
+
+def cfg_to_dot( 
+        blocks
+      , indicate_dead     = True
+      , *
+      , collapse          = False
+      , max_instructions  = None
+      , cluster_loops     = False
+      , around            = None
+      , radius            = 2
+      ) :
+
+  # Describes an annotated control flow graph as DOT text. For large
+  # graphs, the amount of detail can be cut down in a few ways:
+  #
+  #   * `collapse` draws chains of blocks that can only be run one
+  #     after the other as a single node
+  #   * `max_instructions` limits the instructions listed per node
+  #   * `cluster_loops` boxes the blocks of each loop, nested the
+  #     way that the loops are
+  #   * `around` limits the graph to blocks within `radius` edges
+  #     of the block containing the instruction at that address: a
+  #     byte offset in the graphs handed to the visualization hook,
+  #     an instruction index in those of an `Analysis`
+
+  if around is not None :
+    blocks = _neighbourhood( blocks, around, radius )
+
+  if collapse :
+    chains = _linear_chains( blocks )
+  else :
+    chains = { ip : [ip] for ip in blocks }
+
+  G = DotGraph()
+  if cluster_loops :
+    graphs = _loop_clusters( G, blocks, chains )
+  else :
+    graphs = dict.fromkeys( chains, G )
+
+  for ip,members in sorted(chains.items()) :
 
     if ip == IP_START :
       G.add_node( ip, label='START', rank='source' )
@@ -47,58 +85,17 @@ def visualize( se, output, indicate_dead=True ) :
       G.add_node( ip, label='EXCEPT', rank='sink' )
 
     else :
+      label = _block_label( [ blocks[m] for m in members ], max_instructions )
+      graphs[ip].add_node( ip, shape='record', label=label )
 
-      tab = Table( border=0, cellborder=0, cellpadding=3, bgcolor="white" )
-
-      for opip,_,op,raw,_,_,delta in blk.instructions :
-
-        if op in opcode.hasjrel or op in opcode.hasjabs :
-          raw = format_offset( raw )
-        elif op == LOAD_CONST :
-
-          if isinstance(raw,(types.MethodType,types.BuiltinMethodType)) :
-            raw = str.format( '#{}', getattr( raw, 'pretty_name', raw.__qualname__ ) )
-
-          elif isinstance(raw,(types.FunctionType,types.BuiltinFunctionType)) :
-            raw = str.format( '#{}', getattr( raw, 'pretty_name', raw.__name__ ) )
-
-          else :
-            raw = repr(raw)
-            raw = raw.replace( '{', '\\x7b' )
-            raw = raw.replace( '}', '\\x7d' )
-
-        elif op < opcode.HAVE_ARGUMENT :
-          raw = ''
-
-        tab.add( 
-            format_offset(opip)
-          , Tagged( 
-                '{} {}'.format( opcode.opname[op], raw )
-              , align='left'
-              )
-          , Tagged(
-                delta 
-              , align='right'
-              , color='blue' 
-              )
-          )
-
-      for args in blk.values :
-
-        tab.add( 
-            Tagged( 
-                's:{} f:{} e:{}'.format( *args )
-              , colspan=3
-              , bgcolor="gray"
-              )
-          )
-
-      G.add_node( ip, shape='record', label=str(tab) )
 
-
-  for source_ip,sblk in sorted(blocks.items()) :
+  for source_ip,members in sorted(chains.items()) :
+    sblk = blocks[ members[-1] ]
     for target_ip,(s_effect,b_effect,e_effect,no_follow) in sblk.targets.items() :
 
+      if target_ip not in chains :
+        continue
+
       params = {}
 
       if indicate_dead and no_follow is not None :
@@ -120,14 +117,211 @@ def visualize( se, output, indicate_dead=True ) :
 
       G.add_edge( source_ip, target_ip, **params )
 
-  G.draw( output, prog='dot' )
+  return str(G)
+
+
+def _block_label( members, max_instructions ) :
+
+  tab = Table( border=0, cellborder=0, cellpadding=3, bgcolor="white" )
+
+  instructions = [ ins for blk in members for ins in blk.instructions ]
+  hidden = 0
+  if max_instructions is not None and len(instructions) > max_instructions :
+    hidden = len(instructions) - max_instructions
+    instructions = instructions[:max_instructions]
+
+  for opip,_,op,raw,_,_,delta in instructions :
+
+    if op in opcode.hasjrel or op in opcode.hasjabs :
+      raw = format_offset( raw )
+    elif op == LOAD_CONST :
+
+      if isinstance(raw,(types.MethodType,types.BuiltinMethodType)) :
+        raw = str.format( '#{}', getattr( raw, 'pretty_name', raw.__qualname__ ) )
+
+      elif isinstance(raw,(types.FunctionType,types.BuiltinFunctionType)) :
+        raw = str.format( '#{}', getattr( raw, 'pretty_name', raw.__name__ ) )
+
+      else :
+        raw = repr(raw)
+        raw = raw.replace( '{', '\\x7b' )
+        raw = raw.replace( '}', '\\x7d' )
+
+    elif op < opcode.HAVE_ARGUMENT :
+      raw = ''
+
+    tab.add( 
+        format_offset(opip)
+      , Tagged( 
+            '{} {}'.format( opcode.opname[op], raw )
+          , align='left'
+          )
+      , Tagged(
+            delta 
+          , align='right'
+          , color='blue' 
+          )
+      )
+
+  if hidden :
+    tab.add( Tagged( f'... {hidden} more', colspan=3, align='left' ) )
+
+  # the states shown are those on exit from the last block, which
+  # may have been merged
+  if members[-1].widened :
+    tab.add( Tagged( 'widened', colspan=3, align='left', color='red' ) )
+
+  for args in members[-1].values :
+
+    tab.add( 
+        Tagged( 
+            's:{} f:{} e:{}'.format( *args )
+          , colspan=3
+          , bgcolor="gray"
+          )
+      )
+
+  return str(tab)
+
+
+##################################################
+#                                                #
+##################################################
+_pseudo_blocks = frozenset(( IP_START, IP_END, IP_EXCEPT ))
+
+def _neighbourhood( blocks, offset, radius ) :
+
+  # the blocks within `radius` edges, in either direction, of the
+  # block containing `offset`
+  starts = [ ip for ip in blocks if ip not in _pseudo_blocks and ip <= offset ]
+  if not starts :
+    raise ValueError( f'no block contains offset {offset}' )
+
+  neighbours = collections.defaultdict( set )
+  for ip, blk in blocks.items() :
+    for tgt in blk.targets :
+      neighbours[ ip ].add( tgt )
+      neighbours[ tgt ].add( ip )
+
+  frontier = { max(starts) }
+  seen = set( frontier )
+  for _ in range(radius) :
+    frontier = { n for ip in frontier for n in neighbours[ip] } - seen
+    seen |= frontier
+
+  return { ip : blk for ip, blk in blocks.items() if ip in seen }
+
+
+def _is_plain_edge( effects ) :
+  s_effect, b_effect, e_effect, no_follow = effects
+  return no_follow is None and all( 
+      effect_expr_str(effect) == var 
+        for var, effect in (('S',s_effect),('F',b_effect),('E',e_effect)) 
+    )
+
+def _linear_chains( blocks ) :
+
+  # Groups blocks into chains where each block is the only successor
+  # of the one before it, which is in turn its only predecessor, and
+  # control passes between them without any other effect. Returns 
+  # the blocks of each chain, keyed by the first
+  preds = collections.Counter( 
+      tgt for blk in blocks.values() for tgt in blk.targets if tgt in blocks 
+    )
+
+  follows = {}
+  for ip, blk in blocks.items() :
+    if ip in _pseudo_blocks or len(blk.targets) != 1 :
+      continue
+    (tgt, effects), = blk.targets.items()
+    if tgt in blocks and tgt not in _pseudo_blocks and tgt != ip \
+        and preds[tgt] == 1 and _is_plain_edge( effects ) :
+      follows[ tgt ] = ip
+
+  chained = { ip : tgt for tgt, ip in follows.items() }
+
+  chains = {}
+  covered = set()
+  # chains that form a cycle have no natural head, and are started
+  # from their lowest offset
+  for ip in itertools.chain( 
+      sorted( ip for ip in blocks if ip not in follows )
+    , sorted( blocks ) 
+    ) :
+    if ip in covered :
+      continue
+    members = [ip]
+    covered.add( ip )
+    while members[-1] in chained and chained[ members[-1] ] not in covered :
+      members.append( chained[ members[-1] ] )
+      covered.add( members[-1] )
+    chains[ ip ] = members
+
+  return chains
+
+
+def _loop_clusters( G, blocks, chains ) :
+
+  # Finds the natural loops formed by edges that jump backwards, and
+  # nests a cluster for each inside that of the innermost loop that
+  # contains it. Returns the (sub)graph each chain is to be drawn in
+  preds = collections.defaultdict( set )
+  for ip, blk in blocks.items() :
+    for tgt in blk.targets :
+      preds[ tgt ].add( ip )
+
+  loops = collections.defaultdict( set )
+  for ip, blk in blocks.items() :
+    for tgt in blk.targets :
+      if tgt in blocks and tgt not in _pseudo_blocks and ip not in _pseudo_blocks and tgt <= ip :
+        body = loops[ tgt ]
+        body.update( (tgt,ip) )
+        pending = [ip]
+        while pending :
+          for src in preds[ pending.pop() ] :
+            if src not in body and src in blocks :
+              body.add( src )
+              pending.append( src )
+
+  # outermost loops first, so that each can be placed inside the 
+  # smallest loop already placed that contains it
+  graphs = {}
+  placed = []
+  for header, body in sorted( loops.items(), key=lambda kv : (-len(kv[1]),kv[0]) ) :
+    parent = G
+    for other, graph in reversed(placed) :
+      if body <= loops[other] :
+        parent = graph
+        break
+    graph = parent.add_subgraph( 
+                f'cluster_{header}'
+              , label = 'loop ' + format_offset( header )
+              , style = 'dashed'
+              )
+    placed.append( (header, graph) )
+    graphs[ header ] = graph
+
+  result = {}
+  for ip in chains :
+    result[ ip ] = G
+    for header, graph in reversed(placed) :
+      if ip in loops[header] :
+        result[ ip ] = graph
+        break
+
+  return result
 
 
 
 ##################################################
 #                                                #
 ##################################################
-set_visualization_path = make_visualization_hook_manager( assemble, visualize )
+# the package re-exports the `assemble` function under the name of
+# its module, so the module is looked up explicitly
+set_visualization_path = make_visualization_hook_manager( 
+                              importlib.import_module( '.assemble', __package__ )
+                            , cfg_to_dot 
+                            )
 
 
 
@@ -1,16 +1,21 @@
 from . utils import *
 
+import collections
 import html
 import io
 import os
 import posixpath
 
 __all__ = [
-    'Table'
+    'DotGraph'
+  , 'Table'
   , 'Tagged'
   , 'make_visualization_hook_manager'
+  , 'render_dot'
   ]
 
+VisualizationMaxPending = 16
+
 ##################################################
 #                                                #
 ##################################################
@@ -76,34 +81,188 @@ class Table( object ) :
     return buf.getvalue()
 
 
+class DotGraph( object ) :
+
+  # Accumulates a directed graph as DOT text, so that graphs can 
+  # be produced without graphviz being available. Labels that are
+  # tables are written as HTML-like labels
+
+  def __init__( self, name=None, **attrs ) :
+    self._name  = name
+    self._attrs = attrs
+    self._items = []
+
+  def add_node( self, name, **attrs ) :
+    self._items.append( f'{self._id(name)}{self._attr_list(attrs)};' )
+
+  def add_edge( self, source, target, **attrs ) :
+    self._items.append( f'{self._id(source)} -> {self._id(target)}{self._attr_list(attrs)};' )
+
+  def add_subgraph( self, name, **attrs ) :
+    # subgraphs with names starting with `cluster` are drawn boxed
+    graph = DotGraph( name, **attrs )
+    self._items.append( graph )
+    return graph
+
+  def __str__( self ) :
+    buf = io.StringIO()
+    self._write( buf, '' )
+    return buf.getvalue()
+
+  def _write( self, buf, indent ) :
+    if self._name is None :
+      buf.write( indent + 'digraph {\n' )
+    else :
+      buf.write( indent + f'subgraph {self._id(self._name)} {{\n' )
+    inner = indent + '  '
+    for k, v in self._attrs.items() :
+      buf.write( inner + f'{k}={self._value(v)};\n' )
+    for item in self._items :
+      if isinstance(item,DotGraph) :
+        item._write( buf, inner )
+      else :
+        buf.write( inner + item + '\n' )
+    buf.write( indent + '}\n' )
+
+  @staticmethod
+  def _id( name ) :
+    return '"' + str(name).replace( '"', '\\"' ) + '"'
+
+  @classmethod
+  def _value( cls, v ) :
+    v = str(v)
+    if v.startswith( '<' ) and v.endswith( '>' ) :
+      return v
+    return cls._id( v )
+
+  @classmethod
+  def _attr_list( cls, attrs ) :
+    if not attrs :
+      return ''
+    return ' [' + ', '.join( f'{k}={cls._value(v)}' for k, v in attrs.items() ) + ']'
+
+
+def render_dot( dot, output ) :
+
+  # lays out and draws a graph given as DOT text. This is the 
+  # expensive part of visualization, and the only part that needs
+  # graphviz, so it is what the hook hands to worker processes
+  import pygraphviz
+  pygraphviz.AGraph( string=dot ).draw( output, prog='dot' )
+
+
+##################################################
+#                                                #
+##################################################
+class _RenderQueue( object ) :
+
+  # Hands rendering off to a pool of worker processes. At most
+  # `max_pending` graphs are queued or being drawn at once; past
+  # that, graphs are dropped according to `drop`, either the graph
+  # being submitted ('newest') or the oldest that has not yet 
+  # started ('oldest')
+
+  def __init__( self, max_pending, drop, workers ) :
+
+    if drop not in ('newest','oldest') :
+      raise ValueError( f'unknown drop policy {drop!r}' )
+
+    self.max_pending = max_pending
+    self.drop        = drop
+    self.workers     = workers
+    self.dropped     = 0
+    self._pool       = None
+    self._pending    = collections.deque()
+
+  def submit( self, dot, output ) :
+
+    pending = self._pending
+    while pending and pending[0].done() :
+      pending.popleft()
+
+    if len(pending) >= self.max_pending :
+      if self.drop == 'newest' or not self._cancel_oldest() :
+        self.dropped += 1
+        return
+
+    if self._pool is None :
+      from concurrent.futures import ProcessPoolExecutor
+      self._pool = ProcessPoolExecutor( self.workers )
+
+    pending.append( self._pool.submit( render_dot, dot, output ) )
+
+  def _cancel_oldest( self ) :
+    for future in self._pending :
+      if future.cancel() :
+        self._pending.remove( future )
+        self.dropped += 1
+        return True
+    return False
+
+  def close( self ) :
+    if self._pool is not None :
+      self._pool.shutdown( wait=True )
+      self._pool = None
+    self._pending.clear()
+
+
 ##################################################
 #                                                #
 ##################################################
-def make_visualization_hook_manager( mod, f ) :
+def make_visualization_hook_manager( mod, to_dot ) :
+
+  # The hook is called from `assemble` with the name of each function
+  # and its annotated control flow graph. Converting the graph to DOT
+  # text happens on the calling thread, as the graph refers to live
+  # objects, but layout and drawing is left to a background queue. 
+  # With `render=False`, the DOT text is written out as is and 
+  # graphviz is not needed at all. Any other keyword arguments are
+  # passed on to `to_dot`
+
+  queue = None
+
+  def set_visualization_path( 
+          path
+        , fmt         = None
+        , filter      = None
+        , *
+        , render      = True
+        , max_pending = VisualizationMaxPending
+        , drop        = 'newest'
+        , workers     = 1
+        , **options
+        ) :
+
+    nonlocal queue
 
-  def set_visualization_path( path, fmt='{}.png', filter=None ) :
+    if queue is not None :
+      queue.close()
+      queue = None
 
     impl = PASS
 
     if path is not None :
 
       path = posixpath.expanduser( path )
+      os.makedirs( path, exist_ok=True )
 
-      curr = ''
-      for p in path.split( '/' ) :
-        curr += '/' + p
-        if not os.path.exists( curr ) :
-          os.mkdir( curr )
-
+      if fmt is None :
+        fmt = '{}.png' if render else '{}.dot'
       path += '/' + fmt 
 
-      def impl( name, value ) :
+      if render :
+        queue = _RenderQueue( max_pending, drop, workers )
+        emit = queue.submit
+      else :
+        def emit( dot, output ) :
+          with open( output, 'w' ) as f :
+            f.write( dot )
+
+      def impl( name, blocks ) :
         if (filter is None or filter(name)) :
-          f( value, path.format( name ) )
+          emit( to_dot( blocks, **options ), path.format( name ) )
 
     mod._visualization_hook = impl
+    return queue
 
   return set_visualization_path
-
-
-
@@ -1,3 +1,8 @@
+import dis
+import functools
+import subprocess
+import sys
+import threading
 import unittest
 from unittest import TestCase
 
@@ -12,6 +17,1036 @@ class TestByteasm(TestCase):
         f = b.make("f")
         self.assertEqual(f(), 1)
 
+    def testLazyMake(self):
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("a")
+        b.add_positional_arg("b", default=10)
+        b.emit_load_fast("a")
+        b.emit_load_fast("b")
+        b.emit_binary_add()
+        b.emit_load_deref("c")
+        b.emit_binary_add()
+        b.emit_return_value()
+        b.set_closure_value("c", 100)
+        f = b.make("f", lazy=True)
+        stub = f.__code__
+        b.emit_load_const(None)
+        self.assertEqual(f(1), 111)
+        self.assertIsNot(f.__code__, stub)
+        self.assertEqual(f.__code__.co_varnames, ("a", "b"))
+        self.assertEqual(f(1, 2), 103)
+
+        # passes may change the order free variables are first used in
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        b.emit_load_fast("x")
+        b.emit_pop_jump_if_false("ok")
+        b.emit_load_deref("a")
+        b.emit_raise_varargs(1)
+        b.emit_label("ok")
+        b.emit_load_deref("b")
+        b.emit_return_value()
+        b.set_closure_value("a", "A")
+        b.set_closure_value("b", "B")
+        for lazy in (False, True):
+            f = b.make("f", passes=[byteasm.layout_blocks], lazy=lazy)
+            self.assertEqual(f(0), "B")
+
+    def testImportIsLight(self):
+        probe = (
+            "import sys, byteasm; "
+            "print(sorted(m for m in ('inspect', 'byteasm.visualization') if m in sys.modules))"
+        )
+        out = subprocess.check_output([sys.executable, "-c", probe])
+        self.assertEqual(out.strip(), b"[]")
+
+    def testEmittersCreatedOnDemand(self):
+        b = byteasm.FunctionBuilder()
+        self.assertIn("emit_binary_add", dir(b))
+        b.emit_load_const(2)
+        b.emit_load_const(3)
+        b.emit_binary_add()
+        b.emit_return_value()
+        self.assertIn("emit_binary_add", vars(byteasm.EmittersMixin))
+        self.assertEqual(b.make("f")(), 5)
+        with self.assertRaises(AttributeError):
+            b.emit_not_an_opcode()
+
+    def testConstantsKeyedByType(self):
+        b = byteasm.FunctionBuilder()
+        for value in (1, 1.0, True, 0.0, -0.0, (1,), (1.0,), [1], [1]):
+            b.emit_load_const(value)
+            b.emit_pop_top()
+        b.emit_load_const(None)
+        b.emit_return_value()
+        consts = b.make("f").__code__.co_consts
+        self.assertEqual(len(consts), 10)
+        self.assertEqual([type(c) for c in consts[:3]], [int, float, bool])
+        self.assertEqual(str(consts[4]), "-0.0")
+
+    def testLargeConstantsShared(self):
+        def make():
+            b = byteasm.FunctionBuilder()
+            b.emit_load_const(tuple(range(100)))
+            b.emit_return_value()
+            return b.make("f")
+
+        self.assertIs(make()(), make()())
+
+        # the table keeps only the most recently used constants
+        import importlib
+
+        assemble = importlib.import_module("byteasm.assemble")
+        shared = assemble._shared_constants
+        for n in range(assemble.SharedConstantMaxCount + 10):
+            b = byteasm.FunctionBuilder()
+            b.emit_load_const(("bounded", n) * 8)
+            b.emit_return_value()
+            b.make("f")
+        self.assertEqual(len(shared), assemble.SharedConstantMaxCount)
+
+    def testRewriteMethodCalls(self):
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        b.emit_load_const(",")
+        b.emit_load_attr("join")
+        b.emit_load_fast("x")
+        b.emit_load_attr("split")
+        b.emit_load_const("-")
+        b.emit_call_function(1)
+        b.emit_call_function(1)
+        b.emit_load_fast("x")
+        b.emit_load_attr("upper")
+        b.emit_dup_top()
+        b.emit_pop_top()
+        b.emit_call_function(0)
+        b.emit_build_tuple(2)
+        b.emit_return_value()
+        f = b.make("f", passes=[byteasm.rewrite_method_calls])
+        ops = [i.opname for i in dis.get_instructions(f)]
+        self.assertEqual(ops.count("LOAD_METHOD"), 2)
+        self.assertEqual(ops.count("CALL_METHOD"), 2)
+        self.assertEqual(ops.count("LOAD_ATTR"), 1)
+        self.assertEqual(f("a-b"), ("a,b", "A-B"))
+
+    def testBindGlobals(self):
+        fglobals = {"scale": 2}
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        b.emit_load_global("len")
+        b.emit_load_fast("x")
+        b.emit_call_function(1)
+        b.emit_load_global("scale")
+        b.emit_binary_multiply()
+        b.emit_return_value()
+        f = b.make("f", fglobals, bind_globals=("len", "scale"), rebindable=True)
+        self.assertEqual(f.__code__.co_names, ())
+        self.assertEqual(f("abc"), 6)
+        fglobals["scale"] = 3
+        self.assertEqual(f("abc"), 6)
+        self.assertTrue(byteasm.rebind_globals(f))
+        self.assertEqual(f("abc"), 9)
+        self.assertFalse(byteasm.rebind_globals(f))
+        with self.assertRaises(NameError):
+            b.make("g", {}, bind_globals=("scale",))
+
+        # a lazy function is assembled before it is rebound
+        f = b.make("f", fglobals, bind_globals=("len", "scale"), rebindable=True, lazy=True)
+        self.assertFalse(byteasm.rebind_globals(f))
+        fglobals["scale"] = 4
+        self.assertTrue(byteasm.rebind_globals(f))
+        self.assertEqual(f("abc"), 12)
+
+        # bound values are never taken for lazy stand-ins
+        class Realizable:
+            realized = False
+
+            def realize(self):
+                self.realized = True
+
+        obj = Realizable()
+        b = byteasm.FunctionBuilder()
+        b.emit_load_global("obj")
+        b.emit_return_value()
+        f = b.make("f", {"obj": obj}, bind_globals=("obj",), rebindable=True)
+        self.assertFalse(byteasm.rebind_globals(f))
+        self.assertFalse(obj.realized)
+
+    def testReuseLocalSlots(self):
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        for name in ("t0", "t1", "t2"):
+            b.emit_load_fast("x")
+            b.emit_load_const(1)
+            b.emit_binary_add()
+            b.emit_store_fast(name)
+            b.emit_load_fast(name)
+            b.emit_store_fast("x")
+        b.emit_load_fast("x")
+        b.emit_store_fast("u")
+        b.emit_load_fast("x")
+        b.emit_store_fast("v")
+        b.emit_load_fast("u")
+        b.emit_load_fast("v")
+        b.emit_binary_add()
+        b.emit_return_value()
+        f = b.make("f", passes=[byteasm.reuse_local_slots])
+        self.assertEqual(f.__code__.co_varnames, ("x", "t0", "v"))
+        self.assertEqual(f(1), 8)
+
+    def testForwardStores(self):
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        b.emit_load_fast("x")
+        b.emit_store_fast("t")
+        b.emit_load_fast("t")
+        b.emit_load_const(1)
+        b.emit_binary_add()
+        b.emit_store_fast("u")
+        b.emit_load_fast("u")
+        b.emit_load_fast("u")
+        b.emit_binary_multiply()
+        b.emit_store_fast("dead")
+        b.emit_load_fast("x")
+        b.emit_return_value()
+        f = b.make("f", passes=[byteasm.forward_stores])
+        ops = [(i.opname, i.argval) for i in dis.get_instructions(f)]
+        self.assertEqual(
+            ops,
+            [
+                ("LOAD_FAST", "x"),
+                ("LOAD_CONST", 1),
+                ("BINARY_ADD", None),
+                ("DUP_TOP", None),
+                ("STORE_FAST", "u"),
+                ("LOAD_FAST", "u"),
+                ("BINARY_MULTIPLY", None),
+                ("POP_TOP", None),
+                ("LOAD_FAST", "x"),
+                ("RETURN_VALUE", None),
+            ],
+        )
+        self.assertEqual(f(3), 3)
+
+        # a deleted local is read by the delete, so its store is kept
+        def deletes(x):
+            y = x
+            del y
+            return x
+
+        for passes in ([byteasm.forward_stores], [byteasm.reuse_local_slots]):
+            b = byteasm.FunctionBuilder.from_code(deletes)
+            self.assertEqual(b.make("deletes", passes=passes)(4), 4)
+
+    def testLayoutBlocks(self):
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        b.emit_load_fast("x")
+        b.emit_pop_jump_if_true("ok")
+        b.emit_load_global("ValueError")
+        b.emit_raise_varargs(1)
+        b.emit_label("ok")
+        b.emit_load_fast("x")
+        b.emit_load_const(10)
+        b.emit_compare_gt()
+        b.emit_pop_jump_if_false("small")
+        b.emit_load_const("big")
+        b.emit_return_value()
+        b.emit_label("small")
+        b.emit_load_const("small")
+        b.emit_return_value()
+
+        f = b.make("f", passes=[byteasm.layout_blocks])
+        ops = [i.opname for i in dis.get_instructions(f)]
+        self.assertEqual(ops[:2], ["LOAD_FAST", "POP_JUMP_IF_FALSE"])
+        self.assertEqual(ops[-2:], ["LOAD_GLOBAL", "RAISE_VARARGS"])
+        self.assertEqual(f(20), "big")
+        self.assertRaises(ValueError, f, 0)
+
+        layout = functools.partial(byteasm.layout_blocks, weights={"small": 10})
+        f = b.make("f", passes=[layout])
+        ops = [(i.opname, i.argval) for i in dis.get_instructions(f)]
+        self.assertEqual(ops[5:7], [("POP_JUMP_IF_TRUE", 16), ("LOAD_CONST", "small")])
+        self.assertEqual(f(20), "big")
+        self.assertEqual(f(2), "small")
+
+    def testProfileGuidedReordering(self):
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        b.emit_load_fast("x")
+        b.emit_pop_jump_if_false("rare")
+        b.emit_load_const("common")
+        b.emit_return_value()
+        b.emit_label("rare")
+        b.emit_load_const("rare")
+        b.emit_return_value()
+
+        f = b.make("f", instrument=True)
+        for x in (0, 0, 0, 1):
+            f(x)
+        profile = byteasm.profile_of(f)
+        self.assertEqual(profile.block_counts(), {"block_0": 4, "block_1": 1, "rare": 3})
+        self.assertEqual(profile.branch_counts(), {"block_0": (3, 1)})
+
+        g = b.make("f", profile=profile)
+        ops = [(i.opname, i.argval) for i in dis.get_instructions(g)]
+        self.assertEqual(ops[1:3], [("POP_JUMP_IF_TRUE", 8), ("LOAD_CONST", "rare")])
+        self.assertEqual([g(x) for x in (0, 1)], ["rare", "common"])
+
+    def testCellVariablesAndNestedFunctions(self):
+        inner = byteasm.FunctionBuilder()
+        inner.add_positional_arg("step", default=1)
+        inner.emit_load_deref("count")
+        inner.emit_load_fast("step")
+        inner.emit_binary_add()
+        inner.emit_dup_top()
+        inner.emit_store_deref("count")
+        inner.emit_return_value()
+
+        outer = byteasm.FunctionBuilder()
+        outer.add_positional_arg("count")
+        outer.add_cell_var("count")
+        outer.emit_nested_function(inner, "inc")
+        outer.emit_return_value()
+        make_counter = outer.make("make_counter")
+
+        self.assertEqual(make_counter.__code__.co_cellvars, ("count",))
+        inc = make_counter(10)
+        self.assertEqual(inc.__code__.co_freevars, ("count",))
+        self.assertEqual([inc(), inc(), inc(5)], [11, 12, 17])
+
+    def testDebugInfoLevels(self):
+        def build(**kwargs):
+            b = byteasm.FunctionBuilder(**kwargs)
+            for _ in range(3):
+                b.emit_load_const(None)
+                b.emit_pop_top()
+                b.inc_line_number()
+            b.emit_load_const(None)
+            b.emit_return_value()
+            return b
+
+        full = build().make("f", docstring="doc")
+        self.assertEqual(full.__doc__, "doc")
+        self.assertEqual(len(full.__code__.co_lnotab), 6)
+
+        lines = build().make("f", docstring="doc", debug_info="lines")
+        self.assertIsNone(lines.__doc__)
+        self.assertEqual(lines.__code__.co_lnotab, full.__code__.co_lnotab)
+
+        b = build(debug_info="stripped")
+        self.assertEqual({op[0] for op in b._op_buffer}, {1})
+        stripped = b.make("f", docstring="doc")
+        self.assertEqual(stripped.__code__.co_lnotab, b"")
+        self.assertIsNone(stripped.__doc__)
+
+    def testMemoryReport(self):
+        b = byteasm.FunctionBuilder()
+        b.emit_load_const(tuple(range(50)))
+        b.emit_store_fast("table")
+        b.emit_load_fast("table")
+        b.emit_return_value()
+        f = b.make("f")
+        g = b.make("g")
+
+        report = byteasm.memory_report(f)
+        self.assertEqual(report.name, "f")
+        self.assertEqual((report.names, report.varnames, report.stacksize), (0, 1, 1))
+        self.assertGreater(report.consts_size, sys.getsizeof(tuple(range(50))))
+        self.assertGreater(report.total, report.code_size + report.consts_size)
+
+        self.assertIn(f, byteasm.assembled_functions())
+        total, reports = byteasm.memory_summary([f, g])
+        self.assertEqual(sorted(r.name for r in reports), ["f", "g"])
+        self.assertLess(reports[1].consts_size, report.consts_size)
+        self.assertEqual(total, sum(r.total for r in reports))
+
+    def testFromCode(self):
+        offset = 100
+
+        def original(xs, scale=2, *rest, bias=1, **kwargs):
+            total = 0
+            for x in xs:
+                if x > 2:
+                    total += x * scale
+            try:
+                total += len(rest)
+            except TypeError:
+                pass
+            return total + bias + offset + len(kwargs)
+
+        b = byteasm.FunctionBuilder.from_code(original)
+        f = b.make("original", original.__globals__)
+        self.assertEqual(f([1, 2, 3, 4]), original([1, 2, 3, 4]))
+        self.assertEqual(
+            f([5], 3, 1, 2, bias=0, extra=None),
+            original([5], 3, 1, 2, bias=0, extra=None),
+        )
+        self.assertEqual(f.__code__.co_varnames, original.__code__.co_varnames)
+        self.assertEqual(f(xs=[3]), original(xs=[3]))
+
+        # finally blocks inside loops must not grow the modelled stack
+        def with_loop(xs):
+            for x in xs:
+                try:
+                    with x:
+                        pass
+                except OSError:
+                    pass
+            return len(xs)
+
+        def finally_loop(xs):
+            total = 0
+            for x in xs:
+                try:
+                    total += x
+                finally:
+                    total *= 2
+            return total
+
+        f = byteasm.FunctionBuilder.from_code(with_loop).make("with_loop", with_loop.__globals__)
+        self.assertEqual(f([threading.Lock()]), 1)
+        f = byteasm.FunctionBuilder.from_code(finally_loop).make("finally_loop")
+        self.assertEqual(f([1, 2]), finally_loop([1, 2]))
+
+        # a finally block keeps its exception flag across the
+        # statements inside it
+        def nested(xs):
+            for x in xs:
+                try:
+                    if x:
+                        break
+                finally:
+                    with threading.Lock():
+                        pass
+                    print(1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16)
+            return len(xs)
+
+        f = byteasm.FunctionBuilder.from_code(nested).make("nested", nested.__globals__)
+        self.assertGreaterEqual(f.__code__.co_stacksize, nested.__code__.co_stacksize)
+
+        # an instruction that needs EXTENDED_ARG can start a line
+        source = "def wide():\n    x = [%s]\n    return 299.5\n" % ", ".join(
+            "%d.5" % i for i in range(300)
+        )
+        scope = {}
+        exec(compile(source, "wide", "exec"), scope)
+        f = byteasm.FunctionBuilder.from_code(scope["wide"]).make("wide")
+        self.assertEqual([n for _, n in dis.findlinestarts(f.__code__)], [2, 3])
+
+        # parameters must still be in an order python accepts
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("a", default=1)
+        b.add_positional_arg("b")
+        b.emit_load_const(None)
+        b.emit_return_value()
+        with self.assertRaises(ValueError):
+            b.make("f")
+
+    def testInline(self):
+        callee = byteasm.FunctionBuilder()
+        callee.add_positional_arg("x")
+        callee.add_positional_arg("hi", default=10)
+        callee.emit_load_fast("x")
+        callee.emit_load_fast("hi")
+        callee.emit_compare_gt()
+        callee.emit_pop_jump_if_false("small")
+        callee.emit_load_fast("hi")
+        callee.emit_return_value()
+        callee.emit_label("small")
+        callee.emit_load_fast("x")
+        callee.emit_load_deref("scale")
+        callee.emit_binary_multiply()
+        callee.emit_return_value()
+        callee.set_closure_value("scale", 2)
+
+        def caller(**kwargs):
+            b = byteasm.FunctionBuilder()
+            b.add_positional_arg("xs")
+            b.emit_load_const(0)
+            b.emit_store_fast("x")
+            b.emit_load_fast("xs")
+            b.emit_get_iter()
+            b.emit_label("loop")
+            b.emit_for_iter("done")
+            inlined = b.emit_inline(callee, "clamp", 1, **kwargs)
+            b.emit_load_const(1)
+            b.emit_binary_add()
+            b.emit_load_fast("x")
+            b.emit_binary_add()
+            b.emit_store_fast("x")
+            b.emit_jump_absolute("loop")
+            b.emit_label("done")
+            b.emit_load_fast("x")
+            b.emit_return_value()
+            return inlined, b.make("f")
+
+        inlined, f = caller()
+        self.assertTrue(inlined)
+        self.assertEqual(f([1, 20, 3]), 3 + 11 + 7)
+        self.assertNotIn(dis.opmap["CALL_FUNCTION_EX"], f.__code__.co_code[::2])
+
+        inlined, f = caller(max_size=4)
+        self.assertFalse(inlined)
+        self.assertEqual(f([1, 20, 3]), 3 + 11 + 7)
+
+        # a called body sees the globals of the function it is called from
+        callee = byteasm.FunctionBuilder()
+        callee.emit_load_global("limit")
+        callee.emit_return_value()
+        b = byteasm.FunctionBuilder()
+        self.assertFalse(b.emit_inline(callee, "get", 0, max_size=0))
+        b.emit_return_value()
+        self.assertEqual(b.make("f", {"limit": 5})(), 5)
+        self.assertEqual(b.make("f", {"limit": 6}, lazy=True)(), 6)
+        with self.assertRaises(ValueError):
+            b.make_code("f")
+
+    def testUnrolledLoop(self):
+        def make(values, **kwargs):
+            b = byteasm.FunctionBuilder()
+            b.add_positional_arg("x")
+
+            def body(b, load):
+                b.emit_load_fast("x")
+                b.emit_load_const(10)
+                b.emit_binary_multiply()
+                load()
+                b.emit_binary_add()
+                b.emit_store_fast("x")
+
+            b.emit_unrolled_loop(values, body, "v", **kwargs)
+            b.emit_load_fast("x")
+            b.emit_return_value()
+            return b.make("f")
+
+        values = (1, 2, 3, 4, 5)
+        expected = 12345
+        f = make(values)
+        self.assertEqual(f(0), expected)
+        self.assertNotIn(dis.opmap["FOR_ITER"], f.__code__.co_code[::2])
+        self.assertEqual(f.__code__.co_varnames, ("x",))
+
+        for kwargs in ({"unroll": 2}, {"unroll": 1}, {"max_unroll": 4}):
+            f = make(values, **kwargs)
+            self.assertEqual(f(0), expected)
+            self.assertIn(dis.opmap["FOR_ITER"], f.__code__.co_code[::2])
+        self.assertEqual(make(())(7), 7)
+
+    def testVisualizationHook(self):
+        import tempfile
+        from byteasm.visualization import set_visualization_path
+
+        def make():
+            b = byteasm.FunctionBuilder()
+            b.emit_load_const(1)
+            b.emit_return_value()
+            return b.make("f")
+
+        with tempfile.TemporaryDirectory() as path:
+            try:
+                self.assertIsNone(set_visualization_path(path, render=False))
+                self.assertEqual(make()(), 1)
+                with open(path + "/f.dot") as f:
+                    dot = f.read()
+                self.assertTrue(dot.startswith("digraph {"))
+                self.assertIn("LOAD_CONST 1", dot)
+                # instructions are shown at their byte offsets
+                self.assertIn(">0002<", dot)
+                self.assertNotIn(">0001<", dot)
+
+                queue = set_visualization_path(path, max_pending=0)
+                make()
+                make()
+                self.assertEqual(queue.dropped, 2)
+            finally:
+                set_visualization_path(None)
+
+    def testVisualizationOptions(self):
+        from byteasm.visualization import cfg_to_dot
+
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("n")
+        b.emit_load_const(0)
+        b.emit_label("a")
+        b.emit_load_const(1)
+        b.emit_binary_add()
+        b.emit_label("b")
+        b.emit_load_fast("n")
+        b.emit_pop_jump_if_true("a")
+        b.emit_label("c")
+        b.emit_load_const(2)
+        b.emit_binary_add()
+        b.emit_label("d")
+        b.emit_return_value()
+        blocks = byteasm.Analysis(b._op_buffer, b._labels).cfg
+
+        def nodes(dot):
+            return dot.count("shape=")
+
+        self.assertEqual(nodes(cfg_to_dot(blocks)), 5)
+        self.assertEqual(nodes(cfg_to_dot(blocks, collapse=True)), 3)
+        self.assertIn("... 3 more", cfg_to_dot(blocks, collapse=True, max_instructions=1))
+        dot = cfg_to_dot(blocks, cluster_loops=True)
+        self.assertIn('subgraph "cluster_1"', dot)
+        self.assertEqual(nodes(cfg_to_dot(blocks, around=6, radius=0)), 1)
+
+    def testAnalysis(self):
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("n")
+        b.emit_label("top")
+        b.emit_load_fast("n")
+        b.emit_pop_jump_if_false("done")
+        b.emit_load_fast("n")
+        b.emit_load_const(1)
+        b.emit_binary_subtract()
+        b.emit_store_fast("n")
+        b.emit_jump_absolute("top")
+        b.emit_label("done")
+        b.emit_load_const(None)
+        b.emit_return_value()
+
+        a = byteasm.Analysis(list(b._op_buffer), dict(b._labels))
+        self.assertEqual(a.loops, {0: {0, 2}})
+        self.assertEqual(a.dominators[7], {0, 7})
+        self.assertEqual(a.predecessors[0], (2,))
+        self.assertEqual(a.stack_depth, 2)
+        self.assertEqual(a.liveness[0][0], {"n"})
+
+        # changing a constant keeps everything; renaming a local only
+        # invalidates liveness
+        ops = list(a.ops)
+        ops[3] = ops[3][:3] + (2,) + ops[3][4:]
+        c = a.update(ops, a.labels)
+        self.assertIs(c.loops, a.loops)
+        self.assertIs(c.liveness, a.liveness)
+        ops[5] = ops[5][:3] + ("m",) + ops[5][4:]
+        c = a.update(ops, a.labels)
+        self.assertIs(c.cfg, a.cfg)
+        self.assertIsNot(c.liveness, a.liveness)
+        self.assertEqual(c.liveness[0][0], {"n"})
+
+        seen = []
+
+        @byteasm.analysis_pass
+        def check(ops, labels, signature, analysis):
+            seen.append(analysis.ops is ops)
+            return ops, labels
+
+        self.assertEqual(b.make("f", passes=[check])(3), None)
+        self.assertEqual(seen, [True])
+
+    def testVerifier(self):
+        b = byteasm.FunctionBuilder()
+        b.emit_load_const(1)
+        b.inc_line_number()
+        b.emit_binary_add()
+        b.emit_return_value()
+        with self.assertRaises(byteasm.VerifyError) as cm:
+            b.make("f", stackdepth=2)
+        self.assertEqual((cm.exception.index, cm.exception.line), (1, 2))
+
+        # instructions keep their builder index through passes
+        from byteasm.constants import NilArg
+
+        def pad(ops, labels, signature):
+            return [(1, dis.opmap["NOP"], NilArg, None, None)] + ops, labels
+
+        with self.assertRaises(byteasm.VerifyError) as cm:
+            b.make("f", stackdepth=2, passes=[pad])
+        self.assertEqual((cm.exception.index, cm.exception.line), (1, 2))
+
+        b = byteasm.FunctionBuilder()
+        b.emit_load_const(None)
+        b.emit_pop_top()
+        with self.assertRaisesRegex(byteasm.VerifyError, "off the end"):
+            b.make("f", stackdepth=1)
+
+        b = byteasm.FunctionBuilder()
+        b.emit_jump_forward("nowhere")
+        with self.assertRaisesRegex(byteasm.VerifyError, "undefined label"):
+            b.make("f")
+
+        self.assertEqual(byteasm.verify_code(_add.__code__), 2)
+
+        # CALL_FINALLY needs nothing on the stack
+        def handlers(x):
+            try:
+                x = 1 // x
+            except ZeroDivisionError as e:
+                return None
+            try:
+                return x
+            finally:
+                x = 0
+
+        byteasm.verify_code(handlers.__code__)
+        f = byteasm.FunctionBuilder.from_code(handlers).make("handlers")
+        self.assertEqual((f(0), f(1)), (None, 1))
+
+    def testLongRelativeJump(self):
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        b.emit_load_fast("x")
+        b.emit_pop_jump_if_true("skip")
+        b.emit_load_const(0)
+        b.emit_jump_forward("done")
+        b.emit_label("skip")
+        for _ in range(200):
+            b.emit_nop()
+        b.emit_load_const(1)
+        b.emit_label("done")
+        b.emit_return_value()
+        f = b.make("f", verify=False)
+        self.assertEqual(f(False), 0)
+        self.assertEqual(f(True), 1)
+        self.assertEqual(byteasm.verify_code(f.__code__), 1)
+
+        # relative arguments are measured from the end of the jump,
+        # including any EXTENDED_ARG prefix
+        for n in (0, 1, 126, 127, 128, 129, 300):
+            b = byteasm.FunctionBuilder()
+            b.emit_jump_forward("done")
+            for _ in range(n):
+                b.emit_nop()
+            b.emit_label("done")
+            b.emit_load_const(None)
+            b.emit_return_value()
+            f = b.make("f", verify=False)
+            jump = next(i for i in dis.get_instructions(f) if i.opname == "JUMP_FORWARD")
+            target = next(i for i in dis.get_instructions(f) if i.opname == "LOAD_CONST")
+            self.assertEqual(jump.argval, target.offset)
+
+    def testAsync(self):
+        import asyncio
+        import inspect
+
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        b.emit_load_fast("x")
+        b.emit_get_awaitable()
+        b.emit_load_const(None)
+        b.emit_yield_from()
+        b.emit_return_value()
+        f = b.make("f")
+        self.assertTrue(inspect.iscoroutinefunction(f))
+        self.assertEqual(asyncio.run(f(asyncio.sleep(0, 5))), 5)
+
+        b = byteasm.FunctionBuilder()
+        b.emit_load_const((1, 2))
+        b.emit_get_yield_from_iter()
+        b.emit_load_const(None)
+        b.emit_yield_from()
+        b.emit_return_value()
+        g = b.make("g")
+        self.assertTrue(inspect.isgeneratorfunction(g))
+        self.assertEqual(list(g()), [1, 2])
+
+        class Context:
+            async def __aenter__(self):
+                return 10
+
+            async def __aexit__(self, *exc):
+                return False
+
+        async def ticks(n):
+            for i in range(n):
+                await asyncio.sleep(0)
+                yield i
+
+        async def original(n):
+            total = 0
+            async with Context() as c:
+                async for i in ticks(n):
+                    total += i * c
+            return total
+
+        async def agen(n):
+            async for i in ticks(n):
+                yield await asyncio.sleep(0, i * 2)
+
+        async def collect(it):
+            return [v async for v in it]
+
+        f = byteasm.FunctionBuilder.from_code(original).make("f", original.__globals__)
+        self.assertTrue(inspect.iscoroutinefunction(f))
+        self.assertEqual(asyncio.run(f(4)), asyncio.run(original(4)))
+        self.assertEqual(f.__code__.co_stacksize, original.__code__.co_stacksize)
+
+        g = byteasm.FunctionBuilder.from_code(agen).make("g", agen.__globals__)
+        self.assertTrue(inspect.isasyncgenfunction(g))
+        self.assertEqual(asyncio.run(collect(g(3))), [0, 2, 4])
+
+        # neither of these uses an async instruction
+        async def plain():
+            return 1
+
+        async def only_yields():
+            yield 1
+
+        f = byteasm.FunctionBuilder.from_code(plain).make("f")
+        self.assertTrue(inspect.iscoroutinefunction(f))
+        self.assertEqual(asyncio.run(f()), 1)
+        g = byteasm.FunctionBuilder.from_code(only_yields).make("g")
+        self.assertTrue(inspect.isasyncgenfunction(g))
+        self.assertEqual(asyncio.run(collect(g())), [1])
+
+        b = byteasm.FunctionBuilder()
+        b.emit_load_const(1)
+        b.emit_return_value()
+        f = b.make("f", coroutine=True)
+        self.assertTrue(inspect.iscoroutinefunction(f))
+        self.assertEqual(asyncio.run(f()), 1)
+        f = b.make("f", lazy=True, coroutine=True)
+        self.assertEqual(asyncio.run(f()), 1)
+        self.assertTrue(inspect.iscoroutinefunction(f))
+
+        b = byteasm.FunctionBuilder()
+        b.emit_load_const(1)
+        b.emit_yield_value()
+        b.emit_pop_top()
+        b.emit_load_const(None)
+        b.emit_return_value()
+        g = b.make("g", async_generator=True)
+        self.assertTrue(inspect.isasyncgenfunction(g))
+        self.assertEqual(asyncio.run(collect(g())), [1])
+
+    def testSwitch(self):
+        def make(cases, **kwargs):
+            b = byteasm.FunctionBuilder()
+            b.add_positional_arg("x")
+            b.emit_load_fast("x")
+            labels = {k: "case_%d" % v for k, v in cases.items()}
+            info = b.emit_switch(labels, "default", **kwargs)
+            for v in sorted(set(cases.values())):
+                b.emit_label("case_%d" % v)
+                b.emit_load_const(v)
+                b.emit_return_value()
+            b.emit_label("default")
+            b.emit_load_const(None)
+            b.emit_return_value()
+            return info, b.make("f")
+
+        ints = {k: k % 7 for k in range(0, 200, 3)}
+        dense = {k: k % 7 for k in range(-10, 60) if k % 4}
+        words = {"w%d" % k: k % 5 for k in range(40)}
+        for cases, lowering in (
+            (ints, "binary"),
+            (dense, "table"),
+            (words, "dict"),
+            ({1: 1, "a": 2}, "linear"),
+        ):
+            info, f = make(cases)
+            self.assertEqual(info.lowering, lowering)
+            for k, v in cases.items():
+                self.assertEqual(f(k), v)
+            self.assertIsNone(f(-50))
+            self.assertIsNone(f(1000))
+            if lowering in ("linear", "dict"):
+                self.assertIsNone(f("missing"))
+
+        linear, _ = make(ints, lowering="linear")
+        binary, _ = make(ints, lowering="binary")
+        self.assertEqual(linear.comparisons, (len(ints) + 1) / 2)
+        self.assertLess(binary.comparisons, 8)
+        self.assertLess(make(words)[0].comparisons, 5)
+        self.assertLess(make(dense)[0].comparisons, 7)
+        self.assertIsNone(make(dense)[1](-8))
+
+        # a table takes values equal to a case, as the others do
+        _, f = make(dense)
+        self.assertEqual((f(3.0), f(2.5), f(True), f("a")), (3, None, 1, None))
+        self.assertFalse(f.__code__.co_varnames[-1].isidentifier())
+
+    def testExpressions(self):
+        def make(source, **kwargs):
+            b = byteasm.FunctionBuilder()
+            for name in "abcd":
+                b.add_positional_arg(name)
+            b.emit_expression(source, **kwargs)
+            b.emit_return_value()
+            return b.make("f")
+
+        args = (3, 5, 7, 11)
+        for source in (
+            "a - (b * (c + d))",
+            "(a if b > c else -d) ** 2 // 3",
+            "a < b and (c or 0) or not d",
+            "max(a, b + c) % len(str(d))",
+            "(a, b)[1] + 2 * 3 - (1 << 4)",
+        ):
+            f = make(source)
+            self.assertEqual(f(*args), eval(source, None, dict(zip("abcd", args))))
+
+        f = make("2 * 3 + a")
+        self.assertEqual(f.__code__.co_consts, (6,))
+        self.assertEqual(make("1 / 0 if a else 2")(0, 0, 0, 0), 2)
+
+        # the deeper operand is evaluated first and swapped back
+        deep = "a - (b - (c - d))"
+        self.assertEqual(make(deep).__code__.co_stacksize, 2)
+        self.assertEqual(make(deep)(*args), 3 - (5 - (7 - 11)))
+        self.assertEqual(make(deep, fold=False).__code__.co_stacksize, 2)
+
+        # a local that may be unbound is loaded where it is written
+        calls = []
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("a")
+        b.add_positional_arg("f")
+        b.emit_load_fast("a")
+        b.emit_pop_jump_if_true("skip")
+        b.emit_load_const(1)
+        b.emit_store_fast("t")
+        b.emit_label("skip")
+        b.emit_expression("t - (f() * 2)")
+        b.emit_return_value()
+        f = b.make("f")
+        self.assertEqual(f(0, lambda: 3), -5)
+        with self.assertRaises(UnboundLocalError):
+            f(1, lambda: calls.append(1))
+        self.assertEqual(calls, [])
+
+    def testRecordDecoder(self):
+        import struct
+
+        fields = [
+            ("magic", 0, "H"),
+            ("numbers", 4, "h", 3),
+            ("name", 10, "4s"),
+            ("size", 14, "H"),
+            ("strings", 16, "h", 3, (22, "size")),
+        ]
+        decode = byteasm.make_record_decoder("Record", fields, encoding="ascii")
+
+        record = struct.pack("<H2x3h4sH3h", 0x11A, 1, -2, 3, b"abcd", 6, 3, -1, 0)
+        buffer = memoryview(b"pad" + record + b"ab\0cd\0" + b"tail")
+        r = decode(buffer, 3)
+        self.assertEqual(type(r).__name__, "Record")
+        self.assertEqual(r.magic, 0x11A)
+        self.assertEqual(r.numbers, (1, -2, 3))
+        self.assertEqual(r.name, b"abcd")
+        self.assertEqual(r.strings, ("cd", None, "ab"))
+
+        # the fields of a record are read without a loop
+        ops = {i.opname for i in dis.get_instructions(decode)}
+        self.assertFalse(ops & {"FOR_ITER", "JUMP_ABSOLUTE"})
+
+        with self.assertRaises(ValueError):
+            byteasm.make_record_decoder("R", [("a", 0, "i"), ("b", 2, "h")])
+        with self.assertRaises(ValueError):
+            byteasm.make_record_decoder("R", [("pair", 0, "2h")])
+
+    def testFrameStacks(self):
+        from byteasm.aexpr import cons_expr, empty_frames, tail_expr
+
+        depth = 15
+        source = "def nested(x):\n"
+        for i in range(depth):
+            source += "    " * (i + 1) + "try:\n"
+        source += "    " * (depth + 1) + "x = 1 // x\n"
+        for i in reversed(range(depth)):
+            source += "    " * (i + 1) + "except ZeroDivisionError:\n"
+            source += "    " * (i + 2) + "x = %d\n" % i
+        source += "    return x\n"
+        scope = {}
+        exec(source, scope)
+
+        b = byteasm.FunctionBuilder.from_code(scope["nested"])
+        f = b.make("nested")
+        self.assertEqual(f(0), 14)
+
+        # equal frame stacks are one object, sharing their tails
+        cfg = byteasm.Analysis(b._op_buffer, b._labels).cfg
+        frames = {f for blk in cfg.values() for _, f, _ in blk.values}
+        self.assertEqual(max(map(len, frames)), depth)
+        for frame in frames:
+            if frame:
+                self.assertIn(tail_expr(frame), frames)
+                self.assertIs(cons_expr(*frame, empty_frames), frame)
+
+        # stacks are not kept alive by interning
+        import gc
+        import weakref
+
+        ref = weakref.ref(cons_expr(-1, -2, empty_frames))
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def testWidening(self):
+        from byteasm.aexpr import cons_expr, empty_frames
+        from byteasm.stack import _widen
+
+        # each branch may leave another value on the stack
+        b = byteasm.FunctionBuilder()
+        b.add_positional_arg("x")
+        for i in range(10):
+            skip = b.make_label()
+            b.emit_load_fast("x")
+            b.emit_pop_jump_if_false(skip)
+            b.emit_load_const(i)
+            b.emit_label(skip)
+        b.emit_load_fast("x")
+        b.emit_return_value()
+
+        exact = byteasm.Analysis(b._op_buffer, b._labels)
+        bounded = byteasm.Analysis(b._op_buffer, b._labels, max_states=4)
+        self.assertFalse(exact.widened)
+        self.assertTrue(bounded.widened)
+        self.assertGreaterEqual(bounded.stack_depth, exact.stack_depth)
+        # widened blocks keep one state per set of exception flags
+        for ip in bounded.widened:
+            keys = [(tuple(flag for _, flag in f), e) for _, f, e in bounded.cfg[ip].values]
+            self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(b.make("f")(1), 1)
+
+        states = {
+            (3, cons_expr((4, False), (1, False), empty_frames), False),
+            (5, cons_expr((2, False), (1, False), empty_frames), False),
+            (4, cons_expr((2, True), (1, False), empty_frames), False),
+            (1, empty_frames, True),
+        }
+        self.assertEqual(
+            {(s, tuple(f), e) for s, f, e in _widen(states)},
+            {
+                (5, ((4, False), (1, False)), False),
+                (4, ((2, True), (1, False)), False),
+                (1, (), True),
+            },
+        )
+
+    def testPositionalOnly(self):
+        from inspect import Parameter, Signature
+
+        b = byteasm.FunctionBuilder()
+        b.emit_load_fast("a")
+        b.emit_return_value()
+        signature = Signature([Parameter("a", Parameter.POSITIONAL_ONLY)])
+        f = b.make("f", signature=signature)
+        self.assertEqual(f.__code__.co_posonlyargcount, 1)
+        self.assertEqual(f(2), 2)
+        with self.assertRaises(TypeError):
+            f(a=2)
+
+    def testExceptHandlerFrame(self):
+        # the handler of a SETUP_FINALLY runs inside an EXCEPT_HANDLER
+        # frame, which its POP_EXCEPT pops
+        def handles(x):
+            try:
+                x = 1 // x
+            except ZeroDivisionError:
+                x = -1
+            return x
+
+        b = byteasm.FunctionBuilder.from_code(handles)
+        cfg = byteasm.Analysis(b._op_buffer, b._labels).cfg
+        self.assertEqual(max(len(f) for blk in cfg.values() for _, f, _ in blk.values), 1)
+        f = b.make("handles")
+        self.assertEqual((f(0), f(1)), (-1, 1))
+
+
+def _add(a, b):
+    return a + b
+
 
 if __name__ == "__main__":
     unittest.main()